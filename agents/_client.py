@@ -0,0 +1,110 @@
+"""
+Shared OpenRouter client.
+One AsyncOpenAI instance is reused by every agent so the underlying HTTP
+connection pool (and its keep-alive TLS sessions) survives between stages.
+It is bound to the running event loop; run_workflow closes it on exit.
+The pool speaks HTTP/2 when h2 is installed, so concurrent calls multiplex
+over one connection. Request bodies are serialized with orjson when it is
+installed.
+"""
+import importlib.util
+import httpx
+from openai import AsyncOpenAI
+from openai import _base_client
+import config
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+_client = None
+_sdk_dumps = None
+
+
+def _orjson_dumps(obj) -> bytes:
+    """
+    orjson replacement for the SDK's request body serializer.
+
+    Request bodies carry multi-megabyte base64 image strings, which the stdlib
+    encoder walks in Python; orjson serializes them in C. Objects orjson can't
+    handle fall back to the SDK's own encoder.
+    """
+    try:
+        return orjson.dumps(obj)
+    except TypeError:
+        return _sdk_dumps(obj)
+
+
+def _install_orjson():
+    """Route the SDK's JSON body serialization through orjson (once per process)."""
+    global _sdk_dumps
+    if orjson is None or _sdk_dumps is not None or not hasattr(_base_client, "openapi_dumps"):
+        return
+    _sdk_dumps = _base_client.openapi_dumps
+    _base_client.openapi_dumps = _orjson_dumps
+
+
+def _build_http_client() -> httpx.AsyncClient:
+    """HTTP client with a sized connection pool, using HTTP/2 when h2 is available."""
+    transport = httpx.AsyncHTTPTransport(
+        http2=importlib.util.find_spec("h2") is not None,
+        limits=httpx.Limits(
+            max_connections=config.HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=config.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=config.HTTP_KEEPALIVE_EXPIRY_SECONDS,
+        ),
+        retries=2,  # Connection-level retries; the SDK retries failed requests
+    )
+    return httpx.AsyncClient(transport=transport, follow_redirects=True)
+
+
+def get_client() -> AsyncOpenAI:
+    """Return the process-wide OpenRouter client, creating it on first use."""
+    global _client
+    if _client is None:
+        _install_orjson()
+        _client = AsyncOpenAI(
+            base_url=config.OPENROUTER_BASE_URL,
+            api_key=config.OPENROUTER_API_KEY,
+            timeout=httpx.Timeout(60.0, connect=10.0),
+            max_retries=2,
+            http_client=_build_http_client(),
+        )
+    return _client
+
+
+async def close_client():
+    """
+    Close the shared client and drop it so the next get_client() builds a new one.
+
+    The pooled connections belong to the event loop that opened them, so the
+    client must not outlive an asyncio.run() call.
+    """
+    global _client
+    if _client is not None:
+        client, _client = _client, None
+        await client.close()
+
+
+def system_message(instructions: str, cache_control: bool = True) -> dict:
+    """
+    System message carrying a prompt's static instructions.
+
+    Keeping the instructions byte-identical and ahead of all per-call content
+    lets providers with prompt caching reuse the prefix. The ephemeral
+    cache_control marker opts in for providers that need it (Anthropic via
+    OpenRouter); others cache identical prefixes automatically.
+
+    Args:
+        instructions: Static instruction text (a module-level constant)
+        cache_control: Add the ephemeral cache_control marker
+
+    Returns:
+        Chat message dict
+    """
+    block = {"type": "text", "text": instructions}
+    if cache_control:
+        block["cache_control"] = {"type": "ephemeral"}
+    return {"role": "system", "content": [block]}
@@ -0,0 +1,168 @@
+"""
+Shared image encoding helpers for vision API calls.
+Encodings are cached on (path, mtime, size), so the same file is only read
+and base64-encoded once while it stays unchanged on disk.
+Also runs image saves/copies in the background; readers of a file that is
+still being written wait for it first (wait_for_file), and loads pipeline
+input images at the pipeline's working resolution.
+"""
+import io
+import os
+import math
+import mmap
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+import config
+
+try:
+    # SIMD (AVX2/NEON) encoder with the same API as the stdlib module
+    import pybase64 as base64
+except ImportError:
+    import base64
+
+# Read chunk size; a multiple of 3 so no chunk produces base64 padding mid-stream
+_ENCODE_CHUNK_SIZE = 57 * 1024
+
+
+# Background file writes, keyed by destination path
+_save_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="image-save")
+_pending_writes = {}
+_pending_lock = threading.Lock()
+
+
+def submit_file_write(output_path: str, write_fn, *args):
+    """
+    Run a blocking write of output_path (e.g. Image.save, shutil.copy) in the background.
+
+    Returns immediately; wait_for_file(output_path) blocks until it has finished.
+    """
+    future = _save_executor.submit(write_fn, *args)
+    with _pending_lock:
+        _pending_writes[os.path.abspath(output_path)] = future
+    return future
+
+
+def save_image_in_background(image: Image.Image, output_path: str):
+    """Save a PIL image without blocking the caller (see submit_file_write)."""
+    return submit_file_write(output_path, image.save, output_path)
+
+
+def wait_for_file(path: str):
+    """Block until a pending background write of path (if any) has finished; re-raises its error."""
+    with _pending_lock:
+        future = _pending_writes.get(os.path.abspath(path))
+    if future is not None:
+        future.result()
+        with _pending_lock:
+            if _pending_writes.get(os.path.abspath(path)) is future:
+                del _pending_writes[os.path.abspath(path)]
+
+
+def wait_for_pending_saves():
+    """Block until every background write has finished."""
+    with _pending_lock:
+        paths = list(_pending_writes)
+    for path in paths:
+        wait_for_file(path)
+
+
+def _file_key(image_path: str) -> tuple:
+    """Cache key that changes whenever the file is rewritten."""
+    wait_for_file(image_path)
+    stat = os.stat(image_path)
+    return os.path.abspath(image_path), stat.st_mtime_ns, stat.st_size
+
+
+def _stream_encode(source, prefix: bytes = b"") -> str:
+    """
+    Base64-encode a binary stream chunk by chunk.
+
+    Only one raw chunk (~57 KB) and its encoding (~76 KB) are in flight at a
+    time, instead of the whole file's bytes alongside the whole encoded copy.
+    The encoding is appended to a buffer that already holds the ASCII prefix
+    (e.g. a data URL header), so no second full-length string is built to
+    prepend it.
+    """
+    encoded = bytearray(prefix)
+    while chunk := source.read(_ENCODE_CHUNK_SIZE):
+        encoded += base64.b64encode(chunk)
+    return encoded.decode("ascii")
+
+
+def _data_url_prefix(mime: str) -> bytes:
+    return f"data:{mime};base64,".encode("ascii")
+
+
+def _has_alpha(image: Image.Image) -> bool:
+    return image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+
+
+def _prepare_vision_bytes(image_path: str, max_side: int) -> tuple:
+    """Downscale and re-encode an image; returns (rewound BytesIO, format)."""
+    with Image.open(image_path) as image:
+        image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+
+        buf = io.BytesIO()
+        if _has_alpha(image):
+            image.convert("RGBA").quantize(colors=64).save(buf, format="PNG", optimize=True)
+            image_format = "png"
+        else:
+            image.convert("RGB").save(buf, format="JPEG", quality=config.VISION_JPEG_QUALITY, optimize=True)
+            image_format = "jpeg"
+
+    buf.seek(0)
+    return buf, image_format
+
+
+@functools.lru_cache(maxsize=64)
+def _vision_data_url_cached(path: str, mtime: int, size: int, max_side: int) -> str:
+    buf, image_format = _prepare_vision_bytes(path, max_side)
+    return _stream_encode(buf, _data_url_prefix(f"image/{image_format}"))
+
+
+def vision_data_url(image_path: str, max_side: int = config.VISION_MAX_SIDE) -> str:
+    """
+    Downscale and re-encode an image as a data URL for an image_url message block.
+
+    The vision model resizes large inputs internally anyway, so sending more
+    than max_side pixels only costs upload bytes and image tokens. Opaque
+    images are re-encoded as JPEG; images with alpha (logos) stay PNG but are
+    quantized to a 64-color palette, which keeps the transparency.
+
+    Args:
+        image_path: Path to the image
+        max_side: Maximum width/height in pixels
+
+    Returns:
+        Data URL string
+    """
+    return _vision_data_url_cached(*_file_key(image_path), max_side)
+
+
+def load_pipeline_image(source, target_area: int = config.PIPELINE_IMAGE_AREA) -> Image.Image:
+    """
+    Open an image (path or file object) as RGB for the diffusers pipeline.
+
+    The pipeline resizes its input to about target_area pixels, so larger JPEG
+    inputs are decoded directly at a reduced DCT scale (Image.draft) instead of
+    at full resolution. Other formats are decoded normally.
+    """
+    image = Image.open(source)
+    width, height = image.size
+    scale = math.sqrt(target_area / (width * height))
+    if scale < 1:
+        # draft picks the smallest DCT scale that is still at least this size
+        image.draft("RGB", (math.ceil(width * scale), math.ceil(height * scale)))
+    return image.convert("RGB")
+
+
+def map_pipeline_image(image_path: str) -> Image.Image:
+    """
+    Decode an image for the pipeline straight from a read-only mmap of the file.
+
+    The decoded image is fully loaded, so the mapping is released on return.
+    """
+    with open(image_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        return load_pipeline_image(mapped)
@@ -0,0 +1,135 @@
+"""
+LLM response cache for OpenRouter chat completions.
+Caches deterministic (temperature 0) responses in memory and on disk.
+"""
+import os
+import json
+import time
+import hashlib
+from typing import Optional
+from openai.types.chat import ChatCompletion
+import config
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# In-memory layer in front of the on-disk cache
+_memory_cache = {}
+
+
+def _cache_key(model: str, messages: list, **params) -> str:
+    """
+    Build the cache key for a chat request.
+
+    Base64 image payloads are part of the messages, so image bytes participate
+    in the hash without extra work.
+    """
+    request = {"model": model, "messages": messages, **params}
+    if orjson is not None:
+        payload = orjson.dumps(request, option=orjson.OPT_SORT_KEYS)
+    else:
+        payload = json.dumps(request, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(payload).hexdigest()
+
+
+def _cache_path(key: str) -> str:
+    return os.path.join(config.LLM_CACHE_DIR, f"{key}.json")
+
+
+def _is_expired(entry: dict) -> bool:
+    return time.time() - entry["created_at"] > config.LLM_CACHE_TTL_SECONDS
+
+
+def get(model: str, messages: list, **params) -> Optional[dict]:
+    """
+    Look up a cached response.
+
+    Args:
+        model: Model name used for the request
+        messages: Chat messages sent with the request
+        **params: Remaining request parameters (max_tokens, temperature, ...)
+
+    Returns:
+        Serialized ChatCompletion dict, or None on miss/expiry
+    """
+    key = _cache_key(model, messages, **params)
+
+    entry = _memory_cache.get(key)
+    if entry is None:
+        path = _cache_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        _memory_cache[key] = entry
+
+    if _is_expired(entry):
+        _memory_cache.pop(key, None)
+        return None
+
+    return entry["response"]
+
+
+def set(model: str, messages: list, response: dict, **params):
+    """
+    Store a response in the memory and disk caches.
+
+    Args:
+        model: Model name used for the request
+        messages: Chat messages sent with the request
+        response: Serialized ChatCompletion dict
+        **params: Remaining request parameters (max_tokens, temperature, ...)
+    """
+    key = _cache_key(model, messages, **params)
+    entry = {"created_at": time.time(), "response": response}
+    _memory_cache[key] = entry
+
+    try:
+        os.makedirs(config.LLM_CACHE_DIR, exist_ok=True)
+        tmp_path = _cache_path(key) + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, _cache_path(key))
+    except OSError as e:
+        config.log_message(f"LLM cache write failed: {str(e)}")
+
+
+async def cached_chat_completion(client, bypass_cache: bool = False, **request) -> ChatCompletion:
+    """
+    Drop-in replacement for client.chat.completions.create with caching.
+
+    Only requests with temperature == 0 are cached, and only when
+    ARIN_LLM_CACHE=1 is set.
+
+    Args:
+        client: AsyncOpenAI client
+        bypass_cache: Skip the cache lookup and store for this request
+        **request: Keyword arguments for chat.completions.create
+
+    Returns:
+        ChatCompletion response (fresh or from cache)
+    """
+    cacheable = (
+        config.LLM_CACHE_ENABLED
+        and not bypass_cache
+        and request.get("temperature") == 0
+    )
+
+    if cacheable:
+        cached = get(**request)
+        if cached is not None:
+            config.log_message("\nLLM cache hit")
+            return ChatCompletion.model_validate(cached)
+
+    response = await client.chat.completions.create(**request)
+
+    if cacheable:
+        set(response=response.model_dump(mode="json"), **request)
+
+    return response
@@ -0,0 +1,227 @@
+"""
+Batch Runner for non-interactive bulk poster generation.
+Submits the stateless planning and text generation stages for a whole dataset
+through the OpenAI Batch API (/v1/batches) at batch pricing instead of
+synchronous chat calls. Image stages still run through main.py per poster.
+
+Usage:
+    python -m agents.batch_runner dataset.jsonl
+
+Each dataset line is a JSON object: {"input_text": "...", "input_image_path": "..."}
+"""
+import os
+import sys
+import json
+import time
+from openai import OpenAI
+import config
+from agents._image_utils import vision_data_url
+from agents.planning_agent import build_planning_prompt, build_planning_messages
+from agents.text_generation_agent import build_text_prompt
+
+
+# Terminal batch statuses
+_FINISHED_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+def load_dataset(dataset_path: str) -> list:
+    """
+    Load (input_text, input_image_path) pairs from a JSONL dataset.
+
+    Args:
+        dataset_path: Path to the dataset file
+
+    Returns:
+        List of (input_text, input_image_path) tuples
+    """
+    dataset = []
+    with open(dataset_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                dataset.append((item["input_text"], item["input_image_path"]))
+    return dataset
+
+
+def _batch_request(custom_id: str, body: dict) -> dict:
+    """Build one line of a batch input file."""
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": body,
+    }
+
+
+def submit_batch(client: OpenAI, requests: list, name: str) -> str:
+    """
+    Upload batch requests and create the batch job.
+
+    Args:
+        client: OpenAI client for the batch endpoint
+        requests: Batch request dicts (see _batch_request)
+        name: Stage name used for the input file name
+
+    Returns:
+        Batch ID
+    """
+    os.makedirs(config.INTERMEDIATE_DIR, exist_ok=True)
+    input_path = os.path.join(config.INTERMEDIATE_DIR, f"batch_{name}_input.jsonl")
+    with open(input_path, "w", encoding="utf-8") as f:
+        for request in requests:
+            f.write(json.dumps(request) + "\n")
+
+    with open(input_path, "rb") as f:
+        input_file = client.files.create(file=f, purpose="batch")
+
+    batch = client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    print(f"Submitted {name} batch {batch.id} ({len(requests)} requests)")
+    config.log_message(f"Submitted {name} batch {batch.id} ({len(requests)} requests)")
+    return batch.id
+
+
+def wait_for_batch(client: OpenAI, batch_id: str):
+    """
+    Poll a batch until it reaches a terminal status.
+
+    Returns:
+        Final batch object
+
+    Raises:
+        RuntimeError: If the batch did not complete
+    """
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        if batch.status in _FINISHED_STATUSES:
+            break
+        print(f"Batch {batch_id} status: {batch.status}")
+        time.sleep(config.BATCH_POLL_INTERVAL_SECONDS)
+
+    if batch.status != "completed":
+        raise RuntimeError(f"Batch {batch_id} finished with status: {batch.status}")
+    return batch
+
+
+def download_results(client: OpenAI, batch) -> dict:
+    """
+    Download the results of a completed batch.
+
+    Returns:
+        Mapping of custom_id -> list of completion contents (one per choice)
+    """
+    results = {}
+    if batch.output_file_id is None:
+        return results
+
+    output = client.files.content(batch.output_file_id).text
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        response = item.get("response") or {}
+        if response.get("status_code") != 200:
+            config.log_message(f"Batch request {item['custom_id']} failed: {item.get('error')}")
+            continue
+        choices = response["body"]["choices"]
+        results[item["custom_id"]] = [choice["message"]["content"] for choice in choices]
+    return results
+
+
+def run_batch(dataset: list) -> list:
+    """
+    Run planning (stage 1) and text generation (stage 2) for a dataset as two
+    chained batches. Stage 2 requests are keyed by the stage 1 custom_id.
+
+    Args:
+        dataset: List of (input_text, input_image_path) tuples
+
+    Returns:
+        List of result dicts with input, planning_output and text_candidates
+    """
+    client = OpenAI(
+        base_url=config.BATCH_BASE_URL,
+        api_key=config.BATCH_API_KEY,
+    )
+
+    # Stage 1: Planning
+    planning_requests = []
+    for i, (input_text, input_image_path) in enumerate(dataset):
+        messages = build_planning_messages(
+            build_planning_prompt(input_text),
+            vision_data_url(input_image_path),
+            cache_control=False,
+        )
+        planning_requests.append(_batch_request(f"plan_{i}", {
+            "model": config.BATCH_MODEL,
+            "messages": messages,
+            "max_tokens": 2000,
+            "temperature": 0,
+        }))
+
+    planning_batch = wait_for_batch(client, submit_batch(client, planning_requests, "planning"))
+    planning_results = download_results(client, planning_batch)
+
+    # Stage 2: Text generation, chained on the planning outputs
+    text_requests = []
+    for i, (input_text, _) in enumerate(dataset):
+        plan = planning_results.get(f"plan_{i}")
+        if not plan:
+            continue
+        text_requests.append(_batch_request(f"text_{i}", {
+            "model": config.BATCH_MODEL,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": build_text_prompt(plan[0], input_text)
+                }
+            ],
+            "max_tokens": 300,
+            "temperature": config.TEXT_GENERATION_TEMPERATURE,
+            "n": config.TEXT_CANDIDATES_PER_CALL,
+        }))
+
+    text_results = {}
+    if text_requests:
+        text_batch = wait_for_batch(client, submit_batch(client, text_requests, "text_generation"))
+        text_results = download_results(client, text_batch)
+
+    results = []
+    for i, (input_text, input_image_path) in enumerate(dataset):
+        plan = planning_results.get(f"plan_{i}")
+        results.append({
+            "input_text": input_text,
+            "input_image_path": input_image_path,
+            "planning_output": plan[0] if plan else None,
+            "text_candidates": text_results.get(f"text_{i}", []),
+        })
+    return results
+
+
+def main():
+    """
+    Entry point: run the batch stages for a dataset and save the results.
+    """
+    if len(sys.argv) != 2:
+        print("Usage: python -m agents.batch_runner dataset.jsonl")
+        sys.exit(1)
+
+    config.init_log()
+    dataset = load_dataset(sys.argv[1])
+    print(f"Loaded {len(dataset)} dataset entries")
+
+    results = run_batch(dataset)
+
+    os.makedirs(config.OUTPUT_DIR, exist_ok=True)
+    output_path = os.path.join(config.OUTPUT_DIR, "batch_results.jsonl")
+    with open(output_path, "w", encoding="utf-8") as f:
+        for result in results:
+            f.write(json.dumps(result) + "\n")
+    print(f"Batch results saved to: {output_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,65 +2,30 @@
 Stage 3: Editor Agent (Validation)
 Validates generated images against planning requirements.
 """
-import base64
-from openai import OpenAI
+import re
+import asyncio
 from state import AgentState
+from agents._client import get_client, system_message
+from agents._llm_cache import cached_chat_completion
+from agents._image_utils import vision_data_url
+from agents import local_gates
 import config
 import traceback
 
 
-def encode_image(image_path: str) -> str:
-    """Encode image to base64 for API transmission."""
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+# Verdict fields of the editor response (VALIDATION, LOGO_INTEGRATED, TEXT_ON_IMAGE, CONFIDENCE),
+# anchored to the start of a line (markdown emphasis allowed) so text quoted inside FEEDBACK is ignored
+_EDITOR_FIELDS_RE = re.compile(
+    r"^[\s*_#>\d.)-]*(?P<field>VALIDATION|LOGO_INTEGRATED|TEXT_ON_IMAGE|CONFIDENCE)[*_]*\s*:[\s*_]*"
+    r"(?P<value>PASS|FAIL|YES|NO|HIGH|LOW)\b",
+    re.IGNORECASE | re.MULTILINE,
+)
 
 
-def editor_agent(state: AgentState) -> AgentState:
-    """
-    Stage 3: Editor Agent (Validation)
-
-    Validates generated images against planning requirements.
-    Checks for:
-    - Relevance to the design plan
-    - Quality of the generated image
-    - Color palette compatibility
-    - Logo integration
-
-    Args:
-        state: Current agent state with planning_output and current_image
-
-    Returns:
-        Updated state with validation_feedback and validation_passed
-    """
-    print("\n=== STAGE 3: EDITOR AGENT (VALIDATION) ===")
-    config.log_stage("STAGE 3: EDITOR AGENT (VALIDATION)", "Starting image validation...")
-
-    attempt_num = state.get("image_attempt_count", 1)
-    complete_failure_count = state.get("image_complete_failure_count", 0)
-    print(f"Validating image attempt {attempt_num} (complete failure count: {complete_failure_count})")
-    config.log_message(f"Image attempt: {attempt_num}, Complete failure count: {complete_failure_count}")
-    config.log_message(f"Current image: {state['current_image']}")
-    config.log_message(f"Input image: {state['input_image_path']}")
-
-    # Initialize OpenRouter client
-    client = OpenAI(
-        base_url=config.OPENROUTER_BASE_URL,
-        api_key=config.OPENROUTER_API_KEY,
-    )
-
-    # Encode the current image and input logo
-    current_image_base64 = encode_image(state["current_image"])
-    input_logo_base64 = encode_image(state["input_image_path"])
-
-    config.log_message("\nImages encoded successfully")
+# Static validation instructions, sent as a cacheable system prefix
+EDITOR_INSTRUCTIONS = """You are a professional design validator. Compare the generated poster image against the original logo and design plan.
 
-    validation_prompt = f"""You are a professional design validator. Compare the generated poster image against the original logo and design plan.
-
-DESIGN PLAN:
-{state["planning_output"]}
-
-ORIGINAL INPUT TEXT:
-{state["input_text"]}
+You will receive the design plan and original input text, followed by two images: the original logo/mascot first, then the generated poster image.
 
 Evaluate the generated image based on:
 1. LOGO INTEGRATION: Does it properly incorporate or complement the input logo/mascot?
@@ -75,15 +40,75 @@ VALIDATION: [PASS or FAIL]
 LOGO_INTEGRATED: [YES or NO]
 FEEDBACK: [Detailed feedback. If FAIL, specify what needs to be fixed. If logo is not integrated, explicitly state this.]
 TEXT_ON_IMAGE: [YES or NO]
+CONFIDENCE: [HIGH or LOW - LOW if the images are not detailed enough to be sure of your verdict]
 
 Be thorough in your evaluation. The logo MUST be visibly integrated into the design."""
 
-    config.log_message(f"\nValidation prompt sent to LLM:\n{validation_prompt}")
+
+def _parse_fields(validation_result: str) -> dict:
+    """Parse the verdict fields in a single regex pass; the first occurrence of each field wins."""
+    fields = {}
+    for match in _EDITOR_FIELDS_RE.finditer(validation_result):
+        fields.setdefault(match["field"].upper(), match["value"].upper())
+    return fields
+
+
+async def _current_image_data_url(state: AgentState, detail: str) -> str:
+    """
+    Data URL of the current image, encoded off the event loop.
+
+    Low detail only sees 512px, so a smaller encoding is sent. The full-size
+    encoding is memoized in state until current_image changes.
+    """
+    if detail == "low":
+        return await asyncio.to_thread(vision_data_url, state.current_image, config.VISION_LOW_DETAIL_MAX_SIDE)
+
+    memo = state._current_image_b64_url
+    if memo is None or memo[0] != state.current_image:
+        memo = (state.current_image, await asyncio.to_thread(vision_data_url, state.current_image))
+        state._current_image_b64_url = memo
+    return memo[1]
+
+
+async def _input_logo_data_url(state: AgentState, detail: str) -> str:
+    """
+    Data URL of the input logo, encoded off the event loop.
+
+    Low detail uses the same smaller encoding as the poster; high detail uses
+    the full-size encoding made once by warmup_state.
+    """
+    if detail == "low":
+        return await asyncio.to_thread(vision_data_url, state.input_image_path, config.VISION_LOW_DETAIL_MAX_SIDE)
+    return state._input_logo_b64_url or await asyncio.to_thread(vision_data_url, state.input_image_path)
+
+
+async def _llm_validate(state: AgentState, bypass_cache: bool, detail: str) -> str:
+    """Run the vision LLM validation at the given image detail and return its raw response text."""
+    # Shared OpenRouter client
+    client = get_client()
+
+    # Encode both images at the size the detail level actually sees
+    current_image_data_url = await _current_image_data_url(state, detail)
+    input_logo_data_url = await _input_logo_data_url(state, detail)
+
+    config.log_message(f"\nImages encoded successfully (detail: {detail})")
+
+    # Per-call content only; the static instructions are the cached system prefix
+    validation_prompt = f"""DESIGN PLAN:
+{state.planning_output}
+
+ORIGINAL INPUT TEXT:
+{state.input_text}"""
+
+    config.log_message(f"\nValidation prompt sent to LLM:\n{EDITOR_INSTRUCTIONS}\n\n{validation_prompt}")
 
     try:
-        response = client.chat.completions.create(
+        response = await cached_chat_completion(
+            client,
+            bypass_cache=bypass_cache,
             model=config.OPENROUTER_MODEL,
             messages=[
+                system_message(EDITOR_INSTRUCTIONS),
                 {
                     "role": "user",
                     "content": [
@@ -94,27 +119,26 @@ Be thorough in your evaluation. The logo MUST be visibly integrated into the des
                         {
                             "type": "image_url",
                             "image_url": {
-                                "url": f"data:image/png;base64,{input_logo_base64}",
-                                "detail": "high"
+                                "url": input_logo_data_url,
+                                "detail": detail
                             }
                         },
                         {
                             "type": "image_url",
                             "image_url": {
-                                "url": f"data:image/png;base64,{current_image_base64}",
-                                "detail": "high"
+                                "url": current_image_data_url,
+                                "detail": detail
                             }
                         }
                     ]
                 }
             ],
             max_tokens=800,
+            temperature=0,
         )
 
         validation_result = response.choices[0].message.content
         config.log_message(f"\nLLM Response:\n{validation_result}")
-
-        state["validation_feedback"] = validation_result
     except Exception as e:
         error_msg = f"ERROR: {str(e)}"
         print(error_msg)
@@ -123,15 +147,81 @@ Be thorough in your evaluation. The logo MUST be visibly integrated into the des
 
         # On error, set validation to failed
         validation_result = f"VALIDATION: FAIL\nERROR: {str(e)}"
-        state["validation_feedback"] = validation_result
+
+    return validation_result
+
+
+async def editor_agent(state: AgentState, bypass_cache: bool = False) -> AgentState:
+    """
+    Stage 3: Editor Agent (Validation)
+
+    Validates generated images against planning requirements.
+    Checks for:
+    - Relevance to the design plan
+    - Quality of the generated image
+    - Color palette compatibility
+    - Logo integration
+
+    Images are first sent at low detail; only a verdict without
+    CONFIDENCE: HIGH is re-checked at high detail.
+
+    With LOCAL_GATE_ENABLED, local checks (agents/local_gates.py) run first and
+    a rejected image fails validation without an LLM call.
+
+    Args:
+        state: Current agent state with planning_output and current_image
+        bypass_cache: Skip the LLM response cache for this call
+
+    Returns:
+        Updated state with validation_feedback and validation_passed
+    """
+    print("\n=== STAGE 3: EDITOR AGENT (VALIDATION) ===")
+    config.log_stage("STAGE 3: EDITOR AGENT (VALIDATION)", "Starting image validation...")
+
+    attempt_num = state.image_attempt_count
+    complete_failure_count = state.image_complete_failure_count
+    print(f"Validating image attempt {attempt_num} (complete failure count: {complete_failure_count})")
+    config.log_message(f"Image attempt: {attempt_num}, Complete failure count: {complete_failure_count}")
+    config.log_message(f"Current image: {state.current_image}")
+    config.log_message(f"Input image: {state.input_image_path}")
+
+    validation_result = None
+    if config.LOCAL_GATE_ENABLED:
+        # Reject obviously broken images locally, without an API call
+        gate_passed, gate_reason, failed_check = await asyncio.to_thread(
+            local_gates.cheap_validate, state.current_image, state.input_image_path
+        )
+        config.log_message(f"\nLocal gate: {'passed' if gate_passed else 'rejected'} ({gate_reason})")
+        if not gate_passed:
+            print(f"Local gate rejected image: {gate_reason}")
+            # Only a missing logo is reported as a logo failure (restart from input.png,
+            # extended retries); blur/size failures are ordinary failed attempts
+            logo_integrated = "NO" if failed_check in local_gates.LOGO_CHECKS else "YES"
+            validation_result = (
+                "VALIDATION: FAIL\n"
+                f"LOGO_INTEGRATED: {logo_integrated}\n"
+                f"FEEDBACK: Local pre-check failed: {gate_reason}\n"
+                "TEXT_ON_IMAGE: NO"
+            )
+
+    if validation_result is None:
+        # Low-detail pre-screen first; escalate to high detail unless the verdict is confident
+        validation_result = await _llm_validate(state, bypass_cache, "low")
+        if _parse_fields(validation_result).get("CONFIDENCE") != "HIGH":
+            print("Low-detail verdict not confident, re-validating at high detail")
+            config.log_message("\nLow-detail verdict not confident, escalating to high detail")
+            validation_result = await _llm_validate(state, bypass_cache, "high")
+    state.validation_feedback = validation_result
+
+    fields = _parse_fields(validation_result)
 
     # Check if validation passed
-    validation_passed = "VALIDATION: PASS" in validation_result.upper()
-    state["validation_passed"] = validation_passed
+    validation_passed = fields.get("VALIDATION") == "PASS"
+    state.validation_passed = validation_passed
 
     # Check if logo is integrated
-    logo_integrated = "LOGO_INTEGRATED: YES" in validation_result.upper()
-    text_on_image = "TEXT_ON_IMAGE: YES" in validation_result.upper()
+    logo_integrated = fields.get("LOGO_INTEGRATED") == "YES"
+    text_on_image = fields.get("TEXT_ON_IMAGE") == "YES"
 
     print(f"Validation result: {'PASSED' if validation_passed else 'FAILED'}")
     print(f"Logo integrated: {'YES' if logo_integrated else 'NO'}")
@@ -143,19 +233,19 @@ Be thorough in your evaluation. The logo MUST be visibly integrated into the des
     config.log_message(f"Text on image: {text_on_image}")
 
     # Update best image if this one passed or is better
-    if validation_passed or state.get("best_image") is None:
-        state["best_image"] = state["current_image"]
-        config.log_message(f"Updated best_image to: {state['current_image']}")
+    if validation_passed or state.best_image is None:
+        state.best_image = state.current_image
+        config.log_message(f"Updated best_image to: {state.current_image}")
 
     # Add structured failure reasons to feedback
     if not logo_integrated:
-        state["validation_feedback"] += "\n\nFAILURE_TYPE: logo_missing"
-        state["validation_feedback"] += "\n\nIMPORTANT: Logo not properly integrated. Must revert to input.png as base."
+        state.validation_feedback += "\n\nFAILURE_TYPE: logo_missing"
+        state.validation_feedback += "\n\nIMPORTANT: Logo not properly integrated. Must revert to input.png as base."
         config.log_message("\nFAILURE TYPE: logo_missing")
 
     if text_on_image:
-        state["validation_feedback"] += "\n\nFAILURE_TYPE: text_present"
-        state["validation_feedback"] += "\n\nIMPORTANT: Text elements were found directly on the image, which is not allowed. Must revert to input.png as base."
+        state.validation_feedback += "\n\nFAILURE_TYPE: text_present"
+        state.validation_feedback += "\n\nIMPORTANT: Text elements were found directly on the image, which is not allowed. Must revert to input.png as base."
         config.log_message("\nFAILURE TYPE: text_present")
 
     return state
@@ -168,9 +258,9 @@ def should_retry_image(state: AgentState) -> str:
     Returns:
         "retry" if should retry image generation, "continue" otherwise
     """
-    attempt_count = state.get("image_attempt_count", 0)
-    complete_failure_count = state.get("image_complete_failure_count", 0)
-    validation_feedback = state.get("validation_feedback", "")
+    attempt_count = state.image_attempt_count
+    complete_failure_count = state.image_complete_failure_count
+    validation_feedback = state.validation_feedback or ""
 
     # Check for complete failure conditions (text present or logo missing)
     is_complete_failure = ("text_present" in validation_feedback.lower() or
@@ -178,7 +268,7 @@ def should_retry_image(state: AgentState) -> str:
                           "logo not" in validation_feedback.lower())
 
     # If validation passed, continue to next stage
-    if state.get("validation_passed"):
+    if state.validation_passed:
         print("\nValidation passed. Proceeding to next stage.")
         config.log_message("\nDecision: Validation passed, proceeding to segmentation.")
         return "continue"
@@ -191,11 +281,11 @@ def should_retry_image(state: AgentState) -> str:
 
     # Extended retry for complete failures (max 15 more)
     elif is_complete_failure and complete_failure_count < config.MAX_IMAGE_COMPLETE_FAILURE_ATTEMPTS:
-        state["image_complete_failure_count"] = complete_failure_count + 1
-        state["image_attempt_count"] = 0  # Reset regular attempt counter
+        state.image_complete_failure_count = complete_failure_count + 1
+        state.image_attempt_count = 0  # Reset regular attempt counter
         print(f"\nComplete failure detected (text present or logo missing).")
-        print(f"Extended retry {state['image_complete_failure_count']}/{config.MAX_IMAGE_COMPLETE_FAILURE_ATTEMPTS}")
-        config.log_message(f"\nDecision: Complete failure detected, extended retry {state['image_complete_failure_count']}/{config.MAX_IMAGE_COMPLETE_FAILURE_ATTEMPTS}")
+        print(f"Extended retry {state.image_complete_failure_count}/{config.MAX_IMAGE_COMPLETE_FAILURE_ATTEMPTS}")
+        config.log_message(f"\nDecision: Complete failure detected, extended retry {state.image_complete_failure_count}/{config.MAX_IMAGE_COMPLETE_FAILURE_ATTEMPTS}")
         config.log_message("Resetting regular attempt counter to 0")
         return "retry"
     else:
@@ -3,14 +3,107 @@ Stage 4: Image Generation Agent
 Generates images using diffusers Qwen-Image-Edit with retry loop.
 """
 import os
-import torch
+import asyncio
+import functools
 from PIL import Image
 from state import AgentState
+from agents._image_utils import save_image_in_background, wait_for_file, load_pipeline_image
+from agents._pipeline import cache_summary, run_pipeline, cached_image_latents
 import config
 import traceback
 
 
-def image_generation_agent(state: AgentState) -> AgentState:
+@functools.lru_cache(maxsize=8)
+def extract_image_prompt(planning_text: str) -> str:
+    """Extract the IMAGE GENERATION PROMPT section of the plan (cached per plan)."""
+    # Try to extract the IMAGE GENERATION PROMPT section
+    prompt = ""
+    if "IMAGE GENERATION PROMPT" in planning_text:
+        prompt_section = planning_text.split("IMAGE GENERATION PROMPT")[1]
+        # Get until next section or end
+        for section_name in ["COLOR PALETTE", "LAYOUT DESIGN", "TEXT REQUIREMENTS"]:
+            if section_name in prompt_section:
+                prompt_section = prompt_section.split(section_name)[0]
+                break
+        prompt = prompt_section.strip()
+    else:
+        # Fallback: use planning output as context
+        prompt = f"Create a poster background based on this design plan: {planning_text}"
+    return prompt
+
+
+def _generate_image(pipeline, base_image_path: str, prompt: str, output_path: str,
+                    use_true_cfg: bool = True, base_image=None) -> list:
+    """
+    Run the diffusers pipeline on the base image and save the result (blocking).
+
+    base_image is the already decoded base image, when available (the input
+    image); otherwise it is loaded from base_image_path.
+
+    IMAGE_CANDIDATES_PER_CALL candidates are denoised as one batch; the first is
+    saved to output_path and the others next to it. Without use_true_cfg the
+    negative-prompt pass is skipped, so each step is a single transformer call.
+
+    Returns:
+        Paths of the extra candidates
+    """
+    # Load input image as PIL Image and convert to RGB
+    if base_image is not None:
+        input_image = base_image
+    else:
+        wait_for_file(base_image_path)
+        input_image = load_pipeline_image(base_image_path)
+    config.log_message(f"Loaded base image: {input_image.size}")
+
+    print("Generating image with diffusers pipeline...")
+    config.log_message("Starting image generation with pipeline...")
+
+    # Prepare inputs for QwenImageEditPipeline
+    inputs = {
+        "image": input_image,
+        "prompt": prompt,
+        "num_inference_steps": config.HUGGINGFACE_INFERENCE_STEPS,
+        "true_cfg_scale": 4.0, #15.0,
+        "negative_prompt": "text",
+        "num_images_per_prompt": config.IMAGE_CANDIDATES_PER_CALL,
+    }
+    if not use_true_cfg:
+        inputs["true_cfg_scale"] = 1.0
+        del inputs["negative_prompt"]
+
+    config.log_message(f"Pipeline parameters: steps={config.HUGGINGFACE_INFERENCE_STEPS}, cfg_scale={inputs['true_cfg_scale']}")
+
+    # Generate image using the pipeline with inference mode (base image encoded once)
+    with cached_image_latents(pipeline, base_image_path):
+        result = run_pipeline(pipeline, **inputs)
+
+    # Extract the generated image (pipeline returns a list)
+    generated_image = result.images[0]
+    config.log_message(f"Image generated successfully: {generated_image.size} ({len(result.images)} candidates)")
+    summary = cache_summary(pipeline)
+    if summary:
+        config.log_message(f"cache-dit summary: {summary}")
+
+    # Save generated images in the background; readers wait for them via wait_for_file
+    config.ensure_intermediate_dir()
+    save_image_in_background(generated_image, output_path)
+
+    candidate_paths = []
+    stem, ext = os.path.splitext(output_path)
+    for i, candidate in enumerate(result.images[1:], start=2):
+        candidate_path = f"{stem}_candidate{i}{ext}"
+        save_image_in_background(candidate, candidate_path)
+        candidate_paths.append(candidate_path)
+    return candidate_paths
+
+
+def _copy_image(source_path: str, output_path: str):
+    """Re-save an image under a new path (blocking)."""
+    wait_for_file(source_path)
+    Image.open(source_path).save(output_path)
+
+
+async def image_generation_agent(state: AgentState) -> AgentState:
     """
     Stage 4: Image Generation Agent
 
@@ -18,7 +111,9 @@ def image_generation_agent(state: AgentState) -> AgentState:
     - Starts with input.png as base image
     - If validation fails but logo not integrated, reverts to input.png
     - Otherwise, can edit previous output
-    - Uses 4 inference steps
+    - Uses HUGGINGFACE_INFERENCE_STEPS inference steps
+    - With IMAGE_CANDIDATES_PER_CALL > 1, one batched call yields several
+      candidates; retries consume the extras before generating again
 
     Args:
         state: Current agent state with planning_output and image_pipeline
@@ -29,57 +124,51 @@ def image_generation_agent(state: AgentState) -> AgentState:
     print("\n=== STAGE 4: IMAGE GENERATION AGENT ===")
     config.log_stage("STAGE 4: IMAGE GENERATION AGENT", "Starting image generation...")
 
-    # Initialize attempt count if not set
-    if "image_attempt_count" not in state or state["image_attempt_count"] is None:
-        state["image_attempt_count"] = 0
+    state.image_attempt_count += 1
+    attempt_num = state.image_attempt_count
 
-    state["image_attempt_count"] += 1
-    attempt_num = state["image_attempt_count"]
-
-    complete_failure_count = state.get("image_complete_failure_count", 0)
+    complete_failure_count = state.image_complete_failure_count
 
     print(f"Image generation attempt: {attempt_num}/{config.MAX_IMAGE_ATTEMPTS}")
     config.log_message(f"Regular attempt: {attempt_num}/{config.MAX_IMAGE_ATTEMPTS}")
     config.log_message(f"Complete failure count: {complete_failure_count}/{config.MAX_IMAGE_COMPLETE_FAILURE_ATTEMPTS}")
 
+    # A retry first uses a candidate left over from the last batched call (no pipeline call)
+    pending = state.pending_image_candidates or []
+    if pending:
+        state.current_image = pending[0]
+        state.pending_image_candidates = pending[1:]
+        print(f"Using pre-generated image candidate: {pending[0]}")
+        config.log_message(f"\nUsing pre-generated image candidate (no pipeline call): {pending[0]}")
+        return state
+
     # Determine which image to use as base
-    base_image_path = state["input_image_path"]  # Default: start with input.png
+    base_image_path = state.input_image_path  # Default: start with input.png
 
     # Check if we should revert to input.png
-    if attempt_num > 1 and state.get("validation_feedback"):
-        if "must revert to input.png" in state["validation_feedback"].lower() or \
-           "logo not properly integrated" in state["validation_feedback"].lower():
+    if attempt_num > 1 and state.validation_feedback:
+        if "must revert to input.png" in state.validation_feedback.lower() or \
+           "logo not properly integrated" in state.validation_feedback.lower():
             print("Reverting to input.png as base image (logo not integrated)")
             config.log_message("Decision: Reverting to input.png as base (logo not integrated)")
-            base_image_path = state["input_image_path"]
-        elif state.get("current_image"):
+            base_image_path = state.input_image_path
+        elif state.current_image:
             # Can edit previous output if logo was integrated
-            base_image_path = state["current_image"]
+            base_image_path = state.current_image
             print(f"Using previous output as base: {base_image_path}")
             config.log_message(f"Decision: Using previous output as base: {base_image_path}")
 
     config.log_message(f"\nBase image path: {base_image_path}")
 
     # Extract image generation prompt from planning output
-    planning_text = state["planning_output"]
+    planning_text = state.planning_output
 
-    # Try to extract the IMAGE GENERATION PROMPT section
-    prompt = ""
-    if "IMAGE GENERATION PROMPT" in planning_text:
-        prompt_section = planning_text.split("IMAGE GENERATION PROMPT")[1]
-        # Get until next section or end
-        for section_name in ["COLOR PALETTE", "LAYOUT DESIGN", "TEXT REQUIREMENTS"]:
-            if section_name in prompt_section:
-                prompt_section = prompt_section.split(section_name)[0]
-                break
-        prompt = prompt_section.strip()
-    else:
-        # Fallback: use planning output as context
-        prompt = f"Create a poster background based on this design plan: {planning_text}"
+    # Base prompt is extracted once per plan; only the feedback suffix changes between retries
+    prompt = extract_image_prompt(planning_text)
 
     # Add feedback from previous attempt if exists
-    if state.get("validation_feedback") and attempt_num > 1:
-        prompt += f"\n\nIMPROVEMENTS NEEDED: {state['validation_feedback'][:300]}"
+    if state.validation_feedback and attempt_num > 1:
+        prompt += f"\n\nIMPROVEMENTS NEEDED: {state.validation_feedback[:300]}"
         config.log_message(f"\nIncluding validation feedback in prompt")
 
     print(f"Using base image: {base_image_path}")
@@ -87,45 +176,23 @@ def image_generation_agent(state: AgentState) -> AgentState:
     config.log_message(f"\nImage generation prompt:\n{prompt}")
 
     # Get pipeline from state
-    pipeline = state.get("image_pipeline")
+    pipeline = state.image_pipeline
     config.log_message(f"\nPipeline loaded: {pipeline is not None}")
 
+    output_path = os.path.join(config.INTERMEDIATE_DIR, f"attempt{attempt_num}.png")
+
     try:
         if pipeline is None:
             print("Warning: Pipeline not initialized! Using base image as fallback.")
             config.log_message("ERROR: Pipeline not initialized!")
             raise Exception("Pipeline not available")
 
-        # Load input image as PIL Image and convert to RGB
-        input_image = Image.open(base_image_path).convert("RGB")
-        config.log_message(f"Loaded base image: {input_image.size}")
-
-        print("Generating image with diffusers pipeline...")
-        config.log_message("Starting image generation with pipeline...")
-
-        # Prepare inputs for QwenImageEditPipeline
-        inputs = {
-            "image": input_image,
-            "prompt": prompt,
-            "num_inference_steps": config.HUGGINGFACE_INFERENCE_STEPS,
-            "true_cfg_scale": 4.0, #15.0,
-            "negative_prompt": "text",
-        }
-
-        config.log_message(f"Pipeline parameters: steps={config.HUGGINGFACE_INFERENCE_STEPS}, cfg_scale=15.0")
-
-        # Generate image using the pipeline with inference mode
-        with torch.inference_mode():
-            result = pipeline(**inputs)
-
-        # Extract the generated image (pipeline returns a list)
-        generated_image = result.images[0]
-        config.log_message(f"Image generated successfully: {generated_image.size}")
-
-        # Save generated image
-        output_path = os.path.join(config.INTERMEDIATE_DIR, f"attempt{attempt_num}.png")
-        os.makedirs(config.INTERMEDIATE_DIR, exist_ok=True)
-        generated_image.save(output_path)
+        # The diffusers call blocks, so it runs in a worker thread
+        use_true_cfg = attempt_num == 1 or config.TRUE_CFG_ON_IMAGE_RETRIES
+        base_image = state.input_image if base_image_path == state.input_image_path else None
+        state.pending_image_candidates = await asyncio.to_thread(
+            _generate_image, pipeline, base_image_path, prompt, output_path, use_true_cfg, base_image
+        )
         print(f"Generated image saved to: {output_path}")
         config.log_message(f"Image saved to: {output_path}")
 
@@ -136,14 +203,12 @@ def image_generation_agent(state: AgentState) -> AgentState:
         config.log_message(f"Traceback:\n{traceback.format_exc()}")
 
         # If generation fails, just use the base image for this attempt
-        output_path = os.path.join(config.INTERMEDIATE_DIR, f"attempt{attempt_num}.png")
-        base_image = Image.open(base_image_path)
-        base_image.save(output_path)
+        await asyncio.to_thread(_copy_image, base_image_path, output_path)
         print(f"Generation failed, using base image as attempt {attempt_num}")
         config.log_message(f"Fallback: Using base image as attempt {attempt_num}")
 
     # Update state
-    state["current_image"] = output_path
+    state.current_image = output_path
     config.log_message(f"\nUpdated current_image to: {output_path}")
 
     return state
@@ -0,0 +1,128 @@
+"""
+Local pre-validation gates for generated images.
+Cheap checks run before the vision LLM validator, so obviously broken
+attempts (wrong size, blurry, logo nowhere to be found) are rejected without
+an API call.
+"""
+import functools
+from typing import Optional, Tuple
+import numpy as np
+import imagehash
+from PIL import Image
+from agents._image_utils import wait_for_file
+import config
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+# CLIP image preprocessing constants
+_CLIP_INPUT_SIZE = 224
+_CLIP_MEAN = np.array([0.48145466, 0.4578275, 0.40821073], dtype=np.float32)
+_CLIP_STD = np.array([0.26862954, 0.26130258, 0.27577711], dtype=np.float32)
+
+# Crop scales (fraction of the shorter side) searched for the logo
+_LOGO_CROP_SCALES = (0.25, 0.4, 0.6)
+_LOGO_CROP_OVERLAP = 2  # Windows per crop width (2 = half-overlapping)
+
+
+def _laplacian_variance(image: Image.Image) -> float:
+    """Variance of the 4-neighbour Laplacian of the grayscale image (low = blurry)."""
+    gray = np.asarray(image.convert("L"), dtype=np.float32)
+    laplacian = (
+        gray[:-2, 1:-1] + gray[2:, 1:-1] + gray[1:-1, :-2] + gray[1:-1, 2:]
+        - 4.0 * gray[1:-1, 1:-1]
+    )
+    return float(laplacian.var())
+
+
+def _min_logo_distance(current: Image.Image, logo: Image.Image) -> int:
+    """Smallest perceptual hash distance between the logo and any crop of the image."""
+    logo_hash = imagehash.phash(logo)
+    width, height = current.size
+    best = None
+    for scale in _LOGO_CROP_SCALES:
+        side = int(min(width, height) * scale)
+        step = max(1, side // _LOGO_CROP_OVERLAP)
+        for top in range(0, height - side + 1, step):
+            for left in range(0, width - side + 1, step):
+                crop = current.crop((left, top, left + side, top + side))
+                distance = imagehash.phash(crop) - logo_hash
+                if best is None or distance < best:
+                    best = distance
+    return best if best is not None else 64
+
+
+@functools.lru_cache(maxsize=1)
+def _clip_session(model_path: str):
+    return onnxruntime.InferenceSession(model_path, providers=["CPUExecutionProvider"])
+
+
+def _clip_embedding(session, image: Image.Image) -> np.ndarray:
+    """Unit-normalized CLIP image embedding from an ONNX vision encoder."""
+    resized = image.convert("RGB").resize((_CLIP_INPUT_SIZE, _CLIP_INPUT_SIZE), Image.Resampling.BICUBIC)
+    pixels = (np.asarray(resized, dtype=np.float32) / 255.0 - _CLIP_MEAN) / _CLIP_STD
+    pixel_values = pixels.transpose(2, 0, 1)[np.newaxis]
+    input_name = session.get_inputs()[0].name
+    embedding = session.run(None, {input_name: pixel_values})[0].reshape(-1)
+    return embedding / np.linalg.norm(embedding)
+
+
+def _clip_similarity(current: Image.Image, logo: Image.Image) -> Optional[float]:
+    """CLIP cosine similarity, or None when no ONNX model is configured/available."""
+    if onnxruntime is None or not config.LOCAL_GATE_CLIP_MODEL_PATH:
+        return None
+    session = _clip_session(config.LOCAL_GATE_CLIP_MODEL_PATH)
+    return float(np.dot(_clip_embedding(session, current), _clip_embedding(session, logo)))
+
+
+# Failed-check names returned by cheap_validate
+CHECK_SIZE = "size"
+CHECK_SHARPNESS = "sharpness"
+CHECK_LOGO = "logo"
+CHECK_CLIP = "clip"
+LOGO_CHECKS = (CHECK_LOGO, CHECK_CLIP)  # Checks that mean the logo is missing from the image
+
+
+def cheap_validate(current_path: str, input_logo_path: str) -> Tuple[bool, str, Optional[str]]:
+    """
+    Run the local gates on a generated image.
+
+    Checks, cheapest first:
+    - Output size matches LOCAL_GATE_EXPECTED_SIZE (when set)
+    - Laplacian variance above LOCAL_GATE_MIN_SHARPNESS (blur)
+    - Some crop of the image is within LOCAL_GATE_MAX_LOGO_PHASH_DISTANCE of the logo
+    - CLIP similarity to the logo of at least LOCAL_GATE_MIN_CLIP_SIMILARITY
+      (only with onnxruntime and LOCAL_GATE_CLIP_MODEL_PATH)
+
+    Args:
+        current_path: Path to the generated image
+        input_logo_path: Path to the input logo
+
+    Returns:
+        (passed, reason, failed_check) where reason describes the first failed
+        check and failed_check is its CHECK_* name (None when all passed)
+    """
+    wait_for_file(current_path)
+    with Image.open(current_path) as current, Image.open(input_logo_path) as logo:
+        current.load()
+        logo.load()
+
+        if config.LOCAL_GATE_EXPECTED_SIZE and current.size != tuple(config.LOCAL_GATE_EXPECTED_SIZE):
+            return False, f"Image size {current.size} does not match expected {tuple(config.LOCAL_GATE_EXPECTED_SIZE)}", CHECK_SIZE
+
+        sharpness = _laplacian_variance(current)
+        if sharpness <= config.LOCAL_GATE_MIN_SHARPNESS:
+            return False, f"Image is too blurry (Laplacian variance {sharpness:.1f} <= {config.LOCAL_GATE_MIN_SHARPNESS})", CHECK_SHARPNESS
+
+        logo_distance = _min_logo_distance(current, logo)
+        if logo_distance > config.LOCAL_GATE_MAX_LOGO_PHASH_DISTANCE:
+            return False, f"Logo not found in image (closest crop hash distance {logo_distance})", CHECK_LOGO
+
+        similarity = _clip_similarity(current, logo)
+        if similarity is not None and similarity < config.LOCAL_GATE_MIN_CLIP_SIMILARITY:
+            return False, f"Image not similar enough to the logo (CLIP similarity {similarity:.3f})", CHECK_CLIP
+
+    return True, "Local checks passed", None
@@ -0,0 +1,119 @@
+"""
+Plan cache for the Planning Agent.
+Stores design plans keyed on an input-text embedding and a logo perceptual hash,
+so similar inputs can reuse (and cheaply adapt) a previous plan.
+"""
+import os
+import sqlite3
+from contextlib import closing
+from typing import Optional, Tuple
+import numpy as np
+import imagehash
+from PIL import Image
+import config
+
+
+def _connect() -> sqlite3.Connection:
+    """Open the plan cache database, creating the table on first use."""
+    os.makedirs(os.path.dirname(config.PLAN_CACHE_PATH), exist_ok=True)
+    connection = sqlite3.connect(config.PLAN_CACHE_PATH)
+    connection.execute(
+        """CREATE TABLE IF NOT EXISTS plans (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            input_text TEXT NOT NULL,
+            goal_embedding BLOB NOT NULL,
+            logo_phash INTEGER NOT NULL,
+            plan TEXT NOT NULL
+        )"""
+    )
+    return connection
+
+
+def _to_signed64(value: int) -> int:
+    """SQLite integers are signed 64-bit; store the unsigned hash bit pattern."""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def _to_unsigned64(value: int) -> int:
+    return value & ((1 << 64) - 1)
+
+
+def compute_logo_phash(image_path: str) -> int:
+    """Compute the 64-bit perceptual hash of the logo image."""
+    with Image.open(image_path) as image:
+        return int(str(imagehash.phash(image)), 16)
+
+
+async def embed_text(client, text: str) -> np.ndarray:
+    """
+    Embed the input text with the configured embedding model.
+
+    Args:
+        client: AsyncOpenAI client pointed at OpenRouter
+        text: Input text to embed
+
+    Returns:
+        Unit-normalized float32 embedding
+    """
+    response = await client.embeddings.create(
+        model=config.PLAN_CACHE_EMBEDDING_MODEL,
+        input=text,
+    )
+    embedding = np.asarray(response.data[0].embedding, dtype=np.float32)
+    return embedding / np.linalg.norm(embedding)
+
+
+def lookup(embedding: np.ndarray, logo_phash: int) -> Optional[Tuple[str, str, float]]:
+    """
+    Find the most similar cached plan.
+
+    A cached plan matches when cosine similarity of the text embeddings is at
+    least PLAN_CACHE_SIMILARITY_THRESHOLD and the logo hashes differ by at most
+    PLAN_CACHE_MAX_PHASH_DISTANCE bits.
+
+    Args:
+        embedding: Unit-normalized embedding of the new input text
+        logo_phash: Perceptual hash of the new logo
+
+    Returns:
+        (cached input_text, cached plan, similarity) for the best match, or None
+    """
+    with closing(_connect()) as connection, connection:
+        rows = connection.execute(
+            "SELECT input_text, goal_embedding, logo_phash, plan FROM plans"
+        ).fetchall()
+
+    best_match = None
+    best_similarity = config.PLAN_CACHE_SIMILARITY_THRESHOLD
+    for input_text, embedding_blob, cached_phash, plan in rows:
+        distance = bin(_to_unsigned64(cached_phash) ^ logo_phash).count("1")
+        if distance > config.PLAN_CACHE_MAX_PHASH_DISTANCE:
+            continue
+
+        cached_embedding = np.frombuffer(embedding_blob, dtype=np.float32)
+        if cached_embedding.shape != embedding.shape:
+            continue
+
+        similarity = float(np.dot(cached_embedding, embedding))
+        if similarity >= best_similarity:
+            best_similarity = similarity
+            best_match = (input_text, plan, similarity)
+
+    return best_match
+
+
+def store(embedding: np.ndarray, logo_phash: int, input_text: str, plan: str):
+    """
+    Store a freshly generated plan.
+
+    Args:
+        embedding: Unit-normalized embedding of the input text
+        logo_phash: Perceptual hash of the logo
+        input_text: Input text the plan was generated for
+        plan: Planning agent output
+    """
+    with closing(_connect()) as connection, connection:
+        connection.execute(
+            "INSERT INTO plans (input_text, goal_embedding, logo_phash, plan) VALUES (?, ?, ?, ?)",
+            (input_text, embedding.astype(np.float32).tobytes(), _to_signed64(logo_phash), plan),
+        )
@@ -3,59 +3,19 @@ Stage 1: Planning Agent
 Analyzes input text and logo to create a comprehensive poster design plan.
 """
 import os
-import base64
-from openai import OpenAI
+import asyncio
+import aiofiles
 from state import AgentState
+from agents._client import get_client, system_message
+from agents._llm_cache import cached_chat_completion
+from agents._image_utils import vision_data_url
+from agents import plan_cache
 import config
 import traceback
 
 
-def encode_image(image_path: str) -> str:
-    """Encode image to base64 for API transmission."""
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
-
-
-def planning_agent(state: AgentState) -> AgentState:
-    """
-    Stage 1: Planning Agent
-
-    Analyzes input text and logo to generate a comprehensive design plan including:
-    - Color palette extraction from logo
-    - Layout design with text placement positions
-    - Text requirements and constraints
-    - Image generation prompt grounded in both logo and input text
-
-    Args:
-        state: Current agent state with input_text and input_image_path
-
-    Returns:
-        Updated state with planning_output
-    """
-    print("\n=== STAGE 1: PLANNING AGENT ===")
-    config.log_stage("STAGE 1: PLANNING AGENT", "Starting planning phase...")
-
-    # Log inputs
-    config.log_message(f"Input text: {state['input_text']}")
-    config.log_message(f"Input image: {state['input_image_path']}")
-
-    # Initialize OpenRouter client
-    client = OpenAI(
-        base_url=config.OPENROUTER_BASE_URL,
-        api_key=config.OPENROUTER_API_KEY,
-    )
-
-    config.log_message(f"\nOpenRouter client initialized")
-    config.log_message(f"Model: {config.OPENROUTER_MODEL}")
-
-    # Encode the input image
-    image_base64 = encode_image(state["input_image_path"])
-    config.log_message(f"Image encoded successfully")
-
-    # Create the planning prompt
-    planning_prompt = f"""You are a professional poster design planner. Analyze the provided logo/mascot image and the following input text to create a comprehensive poster design plan.
-
-INPUT TEXT: {state["input_text"]}
+# Static planning instructions, sent as a cacheable system prefix
+PLANNING_INSTRUCTIONS = """You are a professional poster design planner. Analyze the provided logo/mascot image and the input text given in the user message to create a comprehensive poster design plan.
 
 Your task is to create a detailed design plan that includes:
 
@@ -85,53 +45,186 @@ Be specific and detailed. This plan will guide all subsequent stages of poster g
 
 Format your response with clear section headers: COLOR PALETTE, LAYOUT DESIGN, TEXT REQUIREMENTS, and IMAGE GENERATION PROMPT."""
 
-    config.log_message(f"\nPrompt sent to LLM:\n{planning_prompt}")
 
+def build_planning_prompt(input_text: str) -> str:
+    """Build the per-call part of the planning prompt (see PLANNING_INSTRUCTIONS)."""
+    return f"INPUT TEXT: {input_text}"
+
+
+def build_planning_messages(planning_prompt: str, image_data_url: str, cache_control: bool = True) -> list:
+    """
+    Build the chat messages for a planning request.
+
+    The static instructions go first as the system message so the prefix is
+    identical across requests; the input text and logo image follow.
+    """
+    return [
+        system_message(PLANNING_INSTRUCTIONS, cache_control),
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": planning_prompt
+                },
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": image_data_url
+                    }
+                }
+            ]
+        }
+    ]
+
+
+async def _lookup_cached_plan(client, state: AgentState, bypass_cache: bool):
+    """
+    Look up a similar plan in the plan cache.
+
+    An identical input reuses the cached plan as-is; a similar one is adapted
+    to the new input text with a single call to the smaller PLAN_ADAPT_MODEL.
+
+    Returns:
+        (planning_output or None on miss, plan cache key for storing a new plan)
+    """
     try:
-        # Call OpenRouter API
-        response = client.chat.completions.create(
-            model=config.OPENROUTER_MODEL,
+        embedding = await plan_cache.embed_text(client, state.input_text)
+        logo_phash = state._input_logo_phash
+        # sqlite and image hashing block, so keep them off the event loop (the image branch runs alongside)
+        if logo_phash is None:
+            logo_phash = await asyncio.to_thread(plan_cache.compute_logo_phash, state.input_image_path)
+        match = await asyncio.to_thread(plan_cache.lookup, embedding, logo_phash)
+    except Exception as e:
+        config.log_message(f"\nPlan cache unavailable: {str(e)}")
+        return None, None
+
+    plan_key = (embedding, logo_phash)
+    if match is None:
+        config.log_message("\nPlan cache miss")
+        return None, plan_key
+
+    cached_input_text, cached_plan, similarity = match
+    if cached_input_text == state.input_text:
+        print("Plan cache hit (exact input)")
+        config.log_message("\nPlan cache hit (exact input), reusing cached plan")
+        return cached_plan, None
+
+    print(f"Plan cache hit (similarity {similarity:.3f}), adapting cached plan")
+    config.log_message(f"\nPlan cache hit (similarity {similarity:.3f}), adapting with {config.PLAN_ADAPT_MODEL}")
+
+    adapt_prompt = f"""Adapt this poster design plan to the new input text. Keep the same section headers (COLOR PALETTE, LAYOUT DESIGN, TEXT REQUIREMENTS, IMAGE GENERATION PROMPT) and the same logo color palette, and only change what the new input text requires.
+
+NEW INPUT TEXT: {state.input_text}
+
+EXISTING PLAN:
+{cached_plan}"""
+
+    try:
+        response = await cached_chat_completion(
+            client,
+            bypass_cache=bypass_cache,
+            model=config.PLAN_ADAPT_MODEL,
             messages=[
                 {
                     "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": planning_prompt
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/png;base64,{image_base64}"
-                            }
-                        }
-                    ]
+                    "content": adapt_prompt
                 }
             ],
             max_tokens=2000,
+            temperature=0,
         )
+    except Exception as e:
+        config.log_message(f"\nPlan adaptation failed, falling back to full planning: {str(e)}")
+        return None, plan_key
 
-        planning_output = response.choices[0].message.content
-        config.log_message(f"\nLLM Response:\n{planning_output}")
+    return response.choices[0].message.content, None
 
-    except Exception as e:
-        error_msg = f"ERROR: {str(e)}"
-        print(error_msg)
-        config.log_message(f"\n{error_msg}")
-        config.log_message(f"Traceback:\n{traceback.format_exc()}")
-        raise
+
+async def planning_agent(state: AgentState, bypass_cache: bool = False) -> AgentState:
+    """
+    Stage 1: Planning Agent
+
+    Analyzes input text and logo to generate a comprehensive design plan including:
+    - Color palette extraction from logo
+    - Layout design with text placement positions
+    - Text requirements and constraints
+    - Image generation prompt grounded in both logo and input text
+
+    Args:
+        state: Current agent state with input_text and input_image_path
+        bypass_cache: Skip the LLM response cache for this call
+
+    Returns:
+        Updated state with planning_output
+    """
+    print("\n=== STAGE 1: PLANNING AGENT ===")
+    config.log_stage("STAGE 1: PLANNING AGENT", "Starting planning phase...")
+
+    # Log inputs
+    config.log_message(f"Input text: {state.input_text}")
+    config.log_message(f"Input image: {state.input_image_path}")
+
+    # Shared OpenRouter client
+    client = get_client()
+
+    config.log_message(f"Model: {config.OPENROUTER_MODEL}")
+
+    # Try the plan cache before paying for a full vision planning call
+    planning_output = None
+    plan_key = None
+    if config.PLAN_CACHE_ENABLED:
+        planning_output, plan_key = await _lookup_cached_plan(client, state, bypass_cache)
+
+    if planning_output is None:
+        # Encode the input image
+        image_data_url = state._input_logo_b64_url or vision_data_url(state.input_image_path)
+        config.log_message(f"Image encoded successfully")
+
+        # Create the planning prompt
+        planning_prompt = build_planning_prompt(state.input_text)
+
+        config.log_message(f"\nPrompt sent to LLM:\n{PLANNING_INSTRUCTIONS}\n\n{planning_prompt}")
+
+        try:
+            # Call OpenRouter API
+            response = await cached_chat_completion(
+                client,
+                bypass_cache=bypass_cache,
+                model=config.OPENROUTER_MODEL,
+                messages=build_planning_messages(planning_prompt, image_data_url),
+                max_tokens=2000,
+                temperature=0,
+            )
+
+            planning_output = response.choices[0].message.content
+            config.log_message(f"\nLLM Response:\n{planning_output}")
+
+        except Exception as e:
+            error_msg = f"ERROR: {str(e)}"
+            print(error_msg)
+            config.log_message(f"\n{error_msg}")
+            config.log_message(f"Traceback:\n{traceback.format_exc()}")
+            raise
+
+        if plan_key is not None:
+            try:
+                await asyncio.to_thread(plan_cache.store, *plan_key, state.input_text, planning_output)
+                config.log_message("Stored plan in plan cache")
+            except Exception as e:
+                config.log_message(f"\nPlan cache store failed: {str(e)}")
 
     # Save planning output
-    os.makedirs(config.INTERMEDIATE_DIR, exist_ok=True)
+    config.ensure_intermediate_dir()
     planning_path = os.path.join(config.INTERMEDIATE_DIR, "planning.txt")
-    with open(planning_path, "w") as f:
-        f.write(planning_output)
+    async with aiofiles.open(planning_path, "w") as f:
+        await f.write(planning_output)
 
     print(f"Planning output saved to: {planning_path}")
     print(f"\nPlanning Summary (first 500 chars):\n{planning_output[:500]}...")
     config.log_message(f"\nPlanning output saved to: {planning_path}")
 
     # Update state
-    state["planning_output"] = planning_output
+    state.planning_output = planning_output
 
     return state
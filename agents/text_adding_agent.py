@@ -3,14 +3,56 @@ Stage 6: Text Adding Agent
 Adds text to the image based on layout instructions with retry loop.
 """
 import os
-import torch
+import asyncio
 from PIL import Image
 from state import AgentState
+from agents._image_utils import save_image_in_background, wait_for_file, load_pipeline_image
+from agents._pipeline import run_pipeline, cached_image_latents
 import config
 import traceback
 
 
-def text_adding_agent(state: AgentState) -> AgentState:
+def _add_text(pipeline, base_image_path: str, text_addition_prompt: str, output_path: str):
+    """Run the diffusers pipeline to add text to the base image and save the result (blocking)."""
+    # Load input image as PIL Image and convert to RGB
+    wait_for_file(base_image_path)
+    input_image = load_pipeline_image(base_image_path)
+    config.log_message(f"Loaded base image: {input_image.size}")
+
+    print("Adding text with diffusers pipeline...")
+    config.log_message("Starting text addition with pipeline...")
+
+    # Prepare inputs for QwenImageEditPipeline
+    inputs = {
+        "image": input_image,
+        "prompt": text_addition_prompt,
+        "num_inference_steps": config.HUGGINGFACE_INFERENCE_STEPS,
+        "true_cfg_scale": 10.0,
+        "negative_prompt": "Chinese text",
+    }
+
+    config.log_message(f"Pipeline parameters: steps={config.HUGGINGFACE_INFERENCE_STEPS}, cfg_scale=25.0")
+
+    # Generate image using the pipeline with inference mode (base image encoded once)
+    with cached_image_latents(pipeline, base_image_path):
+        result = run_pipeline(pipeline, **inputs)
+
+    # Extract the generated image (pipeline returns a list)
+    image_with_text = result.images[0]
+    config.log_message(f"Text added successfully: {image_with_text.size}")
+
+    # Saved in the background; readers wait for it via wait_for_file
+    config.ensure_intermediate_dir()
+    save_image_in_background(image_with_text, output_path)
+
+
+def _copy_image(source_path: str, output_path: str):
+    """Re-save an image under a new path (blocking)."""
+    wait_for_file(source_path)
+    Image.open(source_path).save(output_path)
+
+
+async def text_adding_agent(state: AgentState) -> AgentState:
     """
     Stage 6: Text Adding Agent
 
@@ -27,51 +69,49 @@ def text_adding_agent(state: AgentState) -> AgentState:
     print("\n=== STAGE 6: TEXT ADDING AGENT ===")
     config.log_stage("STAGE 6: TEXT ADDING AGENT", "Starting text addition...")
 
-    # Initialize attempt count if not set
-    if "text_adding_attempt_count" not in state or state["text_adding_attempt_count"] is None:
-        state["text_adding_attempt_count"] = 0
-
-    state["text_adding_attempt_count"] += 1
-    attempt_num = state["text_adding_attempt_count"]
+    state.text_adding_attempt_count += 1
+    attempt_num = state.text_adding_attempt_count
 
     print(f"Text adding attempt: {attempt_num}/{config.MAX_TEXT_ADDING_ATTEMPTS}")
     config.log_message(f"Attempt: {attempt_num}/{config.MAX_TEXT_ADDING_ATTEMPTS}")
 
     # Determine which image to use as base
     base_image_path = None
+    editing_previous_poster = False
 
     if attempt_num == 1:
         # First attempt: use best_image from image_generation_agent
-        base_image_path = state.get("best_image") or state.get("current_image")
+        base_image_path = state.best_image or state.current_image
         print("First attempt: Using best image from image generation")
         config.log_message("First attempt: Using best image from image generation")
     else:
         # Check if previous poster_with_text meets criteria
-        previous_poster = state.get("poster_with_text")
-        text_is_correct = state.get("text_is_correct", False)
-        text_is_clear = state.get("text_is_clear", False)
+        previous_poster = state.poster_with_text
+        text_is_correct = state.text_is_correct
+        text_is_clear = state.text_is_clear
 
         # Use previous poster if it has correct text OR clearly generated text
         if previous_poster and os.path.exists(previous_poster) and (text_is_correct or text_is_clear):
             base_image_path = previous_poster
+            editing_previous_poster = True
             print(f"Using previous poster_with_text (correct: {text_is_correct}, clear: {text_is_clear})")
             config.log_message(f"Using previous poster_with_text (correct: {text_is_correct}, clear: {text_is_clear})")
         else:
             # Revert to best image from image generation
-            base_image_path = state.get("best_image") or state.get("current_image")
+            base_image_path = state.best_image or state.current_image
             print("Reverting to best image from image generation")
             config.log_message("Reverting to best image from image generation")
 
     if not base_image_path or not os.path.exists(base_image_path):
         print(f"Warning: Base image not found. Using input image.")
         config.log_message("WARNING: best_image not found, falling back to input image")
-        base_image_path = state["input_image_path"]
+        base_image_path = state.input_image_path
 
     print(f"Adding text to image: {base_image_path}")
     config.log_message(f"Base image for text addition: {base_image_path}")
 
     # Create short prompt for text addition
-    text_content = state.get("best_text") or state.get("generated_text")
+    text_content = state.best_text or state.generated_text
 
     config.log_message(f"\nOriginal text content:\n{text_content}")
 
@@ -96,17 +136,19 @@ def text_adding_agent(state: AgentState) -> AgentState:
     text_addition_prompt = f"Add this text to the poster: {actual_text}"
     config.log_message(f"\nInitial prompt constructed: {text_addition_prompt}")
 
-    # Add specific fix instruction if appropriate
+    # Add specific fix instruction if appropriate (only when editing the previous poster;
+    # from the best image the text has to be added again in full)
     if attempt_num > 1:
-        text_is_correct = state.get("text_is_correct", False)
-        text_is_clear = state.get("text_is_clear", False)
-        specific_fix = state.get("specific_fix", "")
+        text_is_correct = state.text_is_correct
+        text_is_clear = state.text_is_clear
+        specific_fix = state.specific_fix or ""
 
         config.log_message(f"\nRetry logic - text_is_correct: {text_is_correct}, text_is_clear: {text_is_clear}")
         config.log_message(f"Specific fix from validation: {specific_fix}")
 
-        # Only add fix instruction for specific cases
-        if text_is_correct and not text_is_clear:
+        if not editing_previous_poster or not specific_fix:
+            config.log_message("\nKeeping initial prompt (no fix to apply to a previous poster)")
+        elif text_is_correct and not text_is_clear:
             # Text is correct but blurry - add clarity fix
             text_addition_prompt = specific_fix
             print("Replacing prompt with clarity fix instruction")
@@ -127,45 +169,20 @@ def text_adding_agent(state: AgentState) -> AgentState:
     config.log_message(f"{'='*60}")
 
     # Get pipeline from state
-    pipeline = state.get("image_pipeline")
+    pipeline = state.image_pipeline
     config.log_message(f"\nPipeline loaded: {pipeline is not None}")
 
+    # Save image with text (with attempt number for retry tracking)
+    output_path = os.path.join(config.INTERMEDIATE_DIR, f"poster_with_text_attempt{attempt_num}.png")
+
     try:
         if pipeline is None:
             print("Warning: Pipeline not initialized! Using base image as fallback.")
             config.log_message("ERROR: Pipeline not initialized!")
             raise Exception("Pipeline not available")
 
-        # Load input image as PIL Image and convert to RGB
-        input_image = Image.open(base_image_path).convert("RGB")
-        config.log_message(f"Loaded base image: {input_image.size}")
-
-        print("Adding text with diffusers pipeline...")
-        config.log_message("Starting text addition with pipeline...")
-
-        # Prepare inputs for QwenImageEditPipeline
-        inputs = {
-            "image": input_image,
-            "prompt": text_addition_prompt,
-            "num_inference_steps": config.HUGGINGFACE_INFERENCE_STEPS,
-            "true_cfg_scale": 10.0,
-            "negative_prompt": "Chinese text",
-        }
-
-        config.log_message(f"Pipeline parameters: steps={config.HUGGINGFACE_INFERENCE_STEPS}, cfg_scale=25.0")
-
-        # Generate image using the pipeline with inference mode
-        with torch.inference_mode():
-            result = pipeline(**inputs)
-
-        # Extract the generated image (pipeline returns a list)
-        image_with_text = result.images[0]
-        config.log_message(f"Text added successfully: {image_with_text.size}")
-
-        # Save image with text (with attempt number for retry tracking)
-        output_path = os.path.join(config.INTERMEDIATE_DIR, f"poster_with_text_attempt{attempt_num}.png")
-        os.makedirs(config.INTERMEDIATE_DIR, exist_ok=True)
-        image_with_text.save(output_path)
+        # The diffusers call blocks, so it runs in a worker thread
+        await asyncio.to_thread(_add_text, pipeline, base_image_path, text_addition_prompt, output_path)
         print(f"Poster with text saved to: {output_path}")
         config.log_message(f"Image saved to: {output_path}")
 
@@ -176,14 +193,12 @@ def text_adding_agent(state: AgentState) -> AgentState:
         config.log_message(f"Traceback:\n{traceback.format_exc()}")
 
         # If generation fails, just use the base image
-        output_path = os.path.join(config.INTERMEDIATE_DIR, f"poster_with_text_attempt{attempt_num}.png")
-        base_image = Image.open(base_image_path)
-        base_image.save(output_path)
+        await asyncio.to_thread(_copy_image, base_image_path, output_path)
         print(f"Generation failed, using base image without text addition")
         config.log_message(f"Fallback: Using base image as attempt {attempt_num}")
 
     # Update state
-    state["poster_with_text"] = output_path
+    state.poster_with_text = output_path
     config.log_message(f"\nUpdated poster_with_text to: {output_path}")
 
     return state
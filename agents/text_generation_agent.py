@@ -3,21 +3,94 @@ Stage 2: Text Generation Agent
 Generates text based on planning instructions with retry loop.
 """
 import os
-from openai import OpenAI
+import re
+import copy
+import aiofiles
+import asyncio
 from state import AgentState
+from agents._client import get_client
+from agents._llm_cache import cached_chat_completion
 import config
 import traceback
 
 
-def text_generation_agent(state: AgentState) -> AgentState:
+# One "CANDIDATE i: PASS|FAIL - reason" line per candidate, then "BEST: i"
+_CANDIDATE_VERDICT_RE = re.compile(
+    r"^\W*CANDIDATE\s+(?P<index>\d+)\W*:\W*(?P<verdict>PASS|FAIL)\b",
+    re.IGNORECASE | re.MULTILINE,
+)
+_BEST_CANDIDATE_RE = re.compile(r"^\W*BEST\W*:\W*(?P<index>\d+)", re.IGNORECASE | re.MULTILINE)
+
+# Local text checks (see _local_validate_text)
+_TEXT_REQUIREMENTS_RE = re.compile(
+    r"TEXT REQUIREMENTS\W*(?P<section>.*?)(?=\n\W*(?:\d+\.\s*)?IMAGE GENERATION PROMPT|\Z)",
+    re.IGNORECASE | re.DOTALL,
+)
+_MAX_WORDS_RE = re.compile(r"max(?:imum)?\W+(?:of\s+)?(?P<limit>\d+)\s+words", re.IGNORECASE)
+_CHAR_LIMIT_RE = re.compile(
+    r"(?P<label>HEADLINE|BODY|CALL-TO-ACTION|CTA)\b[^\n]*?(?P<limit>\d+)\s*char",
+    re.IGNORECASE,
+)
+_TEXT_ELEMENT_RE = re.compile(
+    r"^\W*(?P<label>HEADLINE|TITLE|BODY|CALL-TO-ACTION|CTA)\W*:\s*(?P<value>.*?)\s*$",
+    re.IGNORECASE | re.MULTILINE,
+)
+_DEFAULT_MAX_WORDS = 8  # Limit stated in both the planning and text prompts
+
+
+def build_text_prompt(planning_output: str, input_text: str) -> str:
+    """Build the text generation prompt from the design plan and input text."""
+    return f"""You are a professional copywriter. Based on the following design plan, generate the text content for the poster.
+
+DESIGN PLAN:
+{planning_output}
+
+ORIGINAL INPUT TEXT:
+{input_text}
+
+Generate the text content following the TEXT REQUIREMENTS section of the design plan. Include:
+1. Headline/Title text
+2. Body text (if specified)
+3. Call-to-action text (if specified)
+There CANNOT be more than 8 words in total between the three sections.
+
+Format your response clearly with labels for each text element (e.g., "HEADLINE:", "BODY:", "CALL-TO-ACTION:").
+Keep text concise and impactful. Follow any character limits specified in the plan."""
+
+
+async def _record_text_attempt(state: AgentState, generated_text: str, attempt_num: int) -> AgentState:
+    """Save a text attempt and make it the current generated_text."""
+    # Save text attempt
+    config.ensure_intermediate_dir()
+    text_path = os.path.join(config.INTERMEDIATE_DIR, f"text_attempt{attempt_num}.txt")
+    async with aiofiles.open(text_path, "w") as f:
+        await f.write(generated_text)
+
+    print(f"Text attempt {attempt_num} saved to: {text_path}")
+    print(f"\nGenerated text (first 300 chars):\n{generated_text[:300]}...")
+    config.log_message(f"\nText saved to: {text_path}")
+
+    # Update state
+    state.generated_text = generated_text
+    if state.best_text is None:
+        state.best_text = generated_text
+        config.log_message(f"Set as best_text (first attempt)")
+
+    return state
+
+
+async def text_generation_agent(state: AgentState, bypass_cache: bool = False) -> AgentState:
     """
     Stage 2: Text Generation Agent
 
     Generates poster text based on planning instructions.
     This is part of a retry loop with the planning agent validation.
+    Samples TEXT_CANDIDATES_PER_CALL candidates in one request; the first becomes
+    generated_text and the rest are kept in pending_text_candidates for validate_text.
 
     Args:
         state: Current agent state with planning_output
+        bypass_cache: Skip the LLM response cache for this call
 
     Returns:
         Updated state with generated_text and incremented text_attempt_count
@@ -25,53 +98,32 @@ def text_generation_agent(state: AgentState) -> AgentState:
     print("\n=== STAGE 2: TEXT GENERATION AGENT ===")
     config.log_stage("STAGE 2: TEXT GENERATION AGENT", "Starting text generation...")
 
-    # Initialize attempt count if not set
-    if "text_attempt_count" not in state or state["text_attempt_count"] is None:
-        state["text_attempt_count"] = 0
-
-    state["text_attempt_count"] += 1
-    attempt_num = state["text_attempt_count"]
+    state.text_attempt_count += 1
+    attempt_num = state.text_attempt_count
 
     print(f"Text generation attempt: {attempt_num}/{config.MAX_TEXT_ATTEMPTS}")
     config.log_message(f"Attempt: {attempt_num}/{config.MAX_TEXT_ATTEMPTS}")
 
-    # Initialize OpenRouter client
-    client = OpenAI(
-        base_url=config.OPENROUTER_BASE_URL,
-        api_key=config.OPENROUTER_API_KEY,
-    )
+    # Shared OpenRouter client
+    client = get_client()
 
-    config.log_message(f"\nOpenRouter client initialized")
     config.log_message(f"Model: {config.OPENROUTER_MODEL}")
 
     # Create text generation prompt based on planning output
-    text_prompt = f"""You are a professional copywriter. Based on the following design plan, generate the text content for the poster.
-
-DESIGN PLAN:
-{state["planning_output"]}
-
-ORIGINAL INPUT TEXT:
-{state["input_text"]}
-
-Generate the text content following the TEXT REQUIREMENTS section of the design plan. Include:
-1. Headline/Title text
-2. Body text (if specified)
-3. Call-to-action text (if specified)
-There CANNOT be more than 8 words in total between the three sections.
-
-Format your response clearly with labels for each text element (e.g., "HEADLINE:", "BODY:", "CALL-TO-ACTION:").
-Keep text concise and impactful. Follow any character limits specified in the plan."""
+    text_prompt = build_text_prompt(state.planning_output, state.input_text)
 
     # Add feedback from previous attempt if exists
-    if state.get("validation_feedback") and attempt_num > 1:
-        text_prompt += f"\n\nPREVIOUS ATTEMPT FEEDBACK:\n{state['validation_feedback']}\n\nPlease address this feedback in your new text generation."
+    if state.text_generation_feedback and attempt_num > 1:
+        text_prompt += f"\n\nPREVIOUS ATTEMPT FEEDBACK:\n{state.text_generation_feedback}\n\nPlease address this feedback in your new text generation."
         config.log_message(f"\nIncluding previous feedback in prompt")
 
     config.log_message(f"\nPrompt sent to LLM:\n{text_prompt}")
 
     try:
         # Call OpenRouter API
-        response = client.chat.completions.create(
+        response = await cached_chat_completion(
+            client,
+            bypass_cache=bypass_cache,
             model=config.OPENROUTER_MODEL,
             messages=[
                 {
@@ -80,10 +132,13 @@ Keep text concise and impactful. Follow any character limits specified in the pl
                 }
             ],
             max_tokens=300,
+            temperature=config.TEXT_GENERATION_TEMPERATURE,
+            n=config.TEXT_CANDIDATES_PER_CALL,
         )
 
-        generated_text = response.choices[0].message.content
-        config.log_message(f"\nLLM Response:\n{generated_text}")
+        candidates = [choice.message.content for choice in response.choices]
+        generated_text = candidates[0]
+        config.log_message(f"\nLLM Response ({len(candidates)} candidates):\n{generated_text}")
 
     except Exception as e:
         error_msg = f"ERROR: {str(e)}"
@@ -92,73 +147,130 @@ Keep text concise and impactful. Follow any character limits specified in the pl
         config.log_message(f"Traceback:\n{traceback.format_exc()}")
         raise
 
-    # Save text attempt
-    os.makedirs(config.INTERMEDIATE_DIR, exist_ok=True)
-    text_path = os.path.join(config.INTERMEDIATE_DIR, f"text_attempt{attempt_num}.txt")
-    with open(text_path, "w") as f:
-        f.write(generated_text)
+    # Keep the extra candidates as pre-generated retry material
+    state.pending_text_candidates = candidates[1:]
 
-    print(f"Text attempt {attempt_num} saved to: {text_path}")
-    print(f"\nGenerated text (first 300 chars):\n{generated_text[:300]}...")
-    config.log_message(f"\nText saved to: {text_path}")
+    return await _record_text_attempt(state, generated_text, attempt_num)
 
-    # Update state
-    state["generated_text"] = generated_text
-    if state.get("best_text") is None:
-        state["best_text"] = generated_text
-        config.log_message(f"Set as best_text (first attempt)")
 
-    return state
+def _local_validate_text(plan: str, generated: str) -> tuple:
+    """
+    Check generated text against the plan's explicit limits without an API call.
 
+    Checks that a HEADLINE label is present, that the labelled elements stay
+    within the plan's word limit (default 8), and any per-element character
+    limits stated in the TEXT REQUIREMENTS section.
 
-def validate_text(state: AgentState) -> AgentState:
+    Args:
+        plan: Planning agent output
+        generated: Generated text with element labels
+
+    Returns:
+        (True, "") if all checks pass, otherwise (False, reason)
+    """
+    requirements = _TEXT_REQUIREMENTS_RE.search(plan)
+    if requirements is None:
+        return False, "Could not find TEXT REQUIREMENTS in the design plan"
+    section = requirements["section"]
+
+    elements = {}
+    for match in _TEXT_ELEMENT_RE.finditer(generated):
+        label = match["label"].upper()
+        label = {"TITLE": "HEADLINE", "CTA": "CALL-TO-ACTION"}.get(label, label)
+        elements[label] = match["value"].strip("\"'* ")
+    if not elements.get("HEADLINE"):
+        return False, "Missing HEADLINE"
+
+    max_words = _MAX_WORDS_RE.search(section)
+    max_words = int(max_words["limit"]) if max_words else _DEFAULT_MAX_WORDS
+    word_count = sum(len(value.split()) for value in elements.values())
+    if word_count > max_words:
+        return False, f"{word_count} words, limit is {max_words}"
+
+    for match in _CHAR_LIMIT_RE.finditer(section):
+        label = match["label"].upper()
+        label = {"CTA": "CALL-TO-ACTION"}.get(label, label)
+        limit = int(match["limit"])
+        if len(elements.get(label, "")) > limit:
+            return False, f"{label} is {len(elements[label])} characters, limit is {limit}"
+
+    return True, ""
+
+
+async def validate_text(state: AgentState, bypass_cache: bool = False) -> AgentState:
     """
     Text validation by Planning Agent.
 
     The planning agent reviews the generated text against its original plan.
+    generated_text and any pending_text_candidates are judged together in a
+    single request, so the design plan is sent once for all candidates. The
+    best passing candidate becomes generated_text and best_text.
+
+    With LOCAL_TEXT_VALIDATION_ENABLED and a single candidate, text that
+    passes _local_validate_text is accepted without an API call; the LLM
+    validator only runs when the local checks fail.
 
     Args:
         state: Current agent state with planning_output and generated_text
+        bypass_cache: Skip the LLM response cache for this call
 
     Returns:
-        Updated state with validation_feedback and validation_passed
+        Updated state with text_generation_feedback and text_generation_passed
     """
     print("\n=== TEXT VALIDATION ===")
     config.log_stage("TEXT VALIDATION", "Validating generated text...")
 
-    # Initialize OpenRouter client
-    client = OpenAI(
-        base_url=config.OPENROUTER_BASE_URL,
-        api_key=config.OPENROUTER_API_KEY,
+    # Shared OpenRouter client
+    client = get_client()
+
+    candidates = [state.generated_text] + list(state.pending_text_candidates or [])
+
+    # Deterministic single-candidate generation: accept on local checks alone
+    if config.LOCAL_TEXT_VALIDATION_ENABLED and len(candidates) == 1:
+        local_passed, local_reason = _local_validate_text(state.planning_output, state.generated_text)
+        config.log_message(f"\nLocal text validation: {'passed' if local_passed else 'failed'} {local_reason}")
+        if local_passed:
+            print("Validation result: PASSED (local checks, no API call)")
+            state.text_generation_feedback = "VALIDATION: PASS\nFEEDBACK: Passed local length and label checks."
+            state.text_generation_passed = True
+            state.best_text = state.generated_text
+            state.pending_text_candidates = []
+            return state
+    candidates_block = "\n\n".join(
+        f"CANDIDATE {i}:\n{candidate}" for i, candidate in enumerate(candidates, start=1)
     )
 
-    config.log_message(f"Generated text to validate:\n{state['generated_text']}")
+    config.log_message(f"Generated text to validate ({len(candidates)} candidates):\n{candidates_block}")
 
-    validation_prompt = f"""You are a design quality validator. Review the generated text against the design plan.
+    validation_prompt = f"""You are a design quality validator. Review each generated text candidate against the design plan.
 
 DESIGN PLAN:
-{state["planning_output"]}
+{state.planning_output}
 
-GENERATED TEXT:
-{state["generated_text"]}
+GENERATED TEXT CANDIDATES:
+{candidates_block}
 
-Evaluate whether the text:
+Evaluate whether each candidate:
 1. Follows the character limits specified
 2. Matches the tone and style requirements
 3. Includes all required text elements
 4. Is appropriate for the poster design
 5. Is limited to 8 words total
 
-Respond in this format:
-VALIDATION: [PASS or FAIL]
-FEEDBACK: [If FAIL, specific issues to fix. If PASS, brief confirmation.]
+Respond with one line per candidate, in this format:
+CANDIDATE 1: [PASS or FAIL] - [If FAIL, specific issues to fix. If PASS, brief confirmation.]
+CANDIDATE 2: ...
+Then on a final line:
+BEST: [number of the best candidate]
 
 Be strict but fair in your evaluation."""
 
     config.log_message(f"\nValidation prompt sent to LLM:\n{validation_prompt}")
 
     try:
-        response = client.chat.completions.create(
+        response = await cached_chat_completion(
+            client,
+            bypass_cache=bypass_cache,
             model=config.OPENROUTER_MODEL,
             messages=[
                 {
@@ -166,25 +278,42 @@ Be strict but fair in your evaluation."""
                     "content": validation_prompt
                 }
             ],
-            max_tokens=500,
+            max_tokens=200 + 150 * len(candidates),
+            temperature=0,
         )
 
         validation_result = response.choices[0].message.content
         config.log_message(f"\nLLM Response:\n{validation_result}")
 
-        state["validation_feedback"] = validation_result
+        state.text_generation_feedback = validation_result
 
-        # Check if validation passed
-        validation_passed = "VALIDATION: PASS" in validation_result.upper()
-        state["validation_passed"] = validation_passed
+        # Per-candidate verdicts; candidates without a parsable line count as failed
+        verdicts = {
+            int(match["index"]): match["verdict"].upper() == "PASS"
+            for match in _CANDIDATE_VERDICT_RE.finditer(validation_result)
+        }
+        passing = [i for i in range(1, len(candidates) + 1) if verdicts.get(i)]
 
-        print(f"Validation result: {'PASSED' if validation_passed else 'FAILED'}")
+        best_match = _BEST_CANDIDATE_RE.search(validation_result)
+        best_index = int(best_match["index"]) if best_match else None
+        if best_index not in passing:
+            best_index = passing[0] if passing else None
+
+        validation_passed = best_index is not None
+        state.text_generation_passed = validation_passed
+
+        print(f"Validation result: {'PASSED' if validation_passed else 'FAILED'} "
+              f"({len(passing)}/{len(candidates)} candidates passed)")
         print(f"Feedback: {validation_result[:200]}...")
-        config.log_message(f"\nValidation passed: {validation_passed}")
+        config.log_message(f"\nValidation passed: {validation_passed} ({len(passing)}/{len(candidates)} candidates passed)")
 
         if validation_passed:
-            state["best_text"] = state["generated_text"]
-            config.log_message(f"Updated best_text")
+            state.generated_text = candidates[best_index - 1]
+            state.best_text = state.generated_text
+            config.log_message(f"Updated best_text (candidate {best_index})")
+
+        # Every candidate has now been judged
+        state.pending_text_candidates = []
 
     except Exception as e:
         error_msg = f"ERROR: {str(e)}"
@@ -193,12 +322,77 @@ Be strict but fair in your evaluation."""
         config.log_message(f"Traceback:\n{traceback.format_exc()}")
 
         # On error, mark as failed
-        state["validation_feedback"] = f"Validation failed due to error: {str(e)}"
-        state["validation_passed"] = False
+        state.text_generation_feedback = f"Validation failed due to error: {str(e)}"
+        state.text_generation_passed = False
 
     return state
 
 
+async def speculative_text_retry(state: AgentState) -> AgentState:
+    """
+    Speculative retry for the text generation loop.
+
+    Launches several generate + validate attempts concurrently and accepts the
+    first one that passes validation; the remaining attempts are cancelled.
+    Each attempt samples TEXT_CANDIDATES_PER_CALL candidates and validates
+    them in one request. Fan-out is bounded by MAX_CONCURRENT_REQUESTS.
+
+    Args:
+        state: Current agent state after a failed text validation
+
+    Returns:
+        State of the accepted attempt (or the last finished one if none passed)
+    """
+    print("\n=== STAGE 2: SPECULATIVE TEXT RETRY ===")
+    base_count = state.text_attempt_count or 0
+    num_attempts = max(1, min(config.SPECULATIVE_TEXT_ATTEMPTS, config.MAX_TEXT_ATTEMPTS - base_count))
+    config.log_stage(
+        "STAGE 2: SPECULATIVE TEXT RETRY",
+        f"Launching {num_attempts} concurrent text attempts (max concurrent: {config.MAX_CONCURRENT_REQUESTS})"
+    )
+
+    semaphore = asyncio.Semaphore(config.MAX_CONCURRENT_REQUESTS)
+
+    async def run_attempt(offset: int) -> AgentState:
+        candidate_state = copy.copy(state)
+        candidate_state.text_attempt_count = base_count + offset
+        async with semaphore:
+            candidate_state = await text_generation_agent(candidate_state)
+            return await validate_text(candidate_state)
+
+    tasks = [asyncio.create_task(run_attempt(offset)) for offset in range(num_attempts)]
+
+    result_state = None
+    last_error = None
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            try:
+                candidate_state = await next_done
+            except Exception as e:
+                last_error = e
+                config.log_message(f"\nSpeculative attempt failed: {str(e)}")
+                continue
+
+            result_state = candidate_state
+            if candidate_state.text_generation_passed:
+                print(f"Speculative attempt {candidate_state.text_attempt_count} passed validation")
+                config.log_message(f"\nAccepted speculative attempt {candidate_state.text_attempt_count}")
+                break
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+    if result_state is None:
+        raise last_error
+
+    # All launched attempts count towards the retry budget
+    result_state.text_attempt_count = base_count + num_attempts
+    config.log_message(f"Text attempts used: {result_state.text_attempt_count}/{config.MAX_TEXT_ATTEMPTS}")
+
+    return result_state
+
+
 def should_retry_text(state: AgentState) -> str:
     """
     Decision function for text generation retry loop.
@@ -206,12 +400,12 @@ def should_retry_text(state: AgentState) -> str:
     Returns:
         "retry" if should retry text generation, "continue" otherwise
     """
-    if state.get("validation_passed"):
-        print("\nText validation passed. Proceeding to image generation.")
-        config.log_message("\nDecision: Text validation passed, proceeding to image generation.")
+    if state.text_generation_passed:
+        print("\nText validation passed. Text branch done.")
+        config.log_message("\nDecision: Text validation passed, text branch done.")
         return "continue"
 
-    if state["text_attempt_count"] >= config.MAX_TEXT_ATTEMPTS:
+    if state.text_attempt_count >= config.MAX_TEXT_ATTEMPTS:
         print(f"\nMax text attempts ({config.MAX_TEXT_ATTEMPTS}) reached. Continuing with best attempt.")
         config.log_message(f"\nDecision: Max text attempts reached, continuing with best attempt")
         return "continue"
@@ -2,60 +2,62 @@
 Stage 6a: Text Validation Agent
 Validates that text added to poster matches generated text exactly.
 """
-import base64
-from openai import OpenAI
+import re
+import asyncio
 from state import AgentState
+from agents._client import get_client, system_message
+from agents._llm_cache import cached_chat_completion
+from agents._image_utils import vision_data_url
 import config
 import traceback
 
 
-def encode_image(image_path: str) -> str:
-    """Encode image to base64 for API transmission."""
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+# Start of a "FIELD:" line, tolerating list numbering and markdown (e.g. "**TEXT_CORRECT:** YES")
+_FIELD_PREFIX = r"^[\s*_#>\d.)-]*{}[*_]*\s*:[\s*_]*"
+_NEXT_FIELD = r"(?=^[\s*_#>\d.)-]*(?:{})\b|\Z)"
 
 
-def text_validation_agent(state: AgentState) -> AgentState:
-    """
-    Stage 6a: Text Validation Agent
+def _field_re(name: str, value: str) -> re.Pattern:
+    return re.compile(_FIELD_PREFIX.format(name) + value, re.IGNORECASE | re.MULTILINE | re.DOTALL)
 
-    Validates that text added to poster matches generated text exactly.
-    Checks for: exact match, blur, cutoff, spelling errors.
 
-    Args:
-        state: Current agent state with best_text and poster_with_text
+# Each field is parsed on its own, so one missing or reformatted line does not reject the rest
+_TEXT_CORRECT_RE = _field_re("TEXT_CORRECT", r"(?P<value>YES|NO)\b")
+_TEXT_CLEAR_RE = _field_re("TEXT_CLEAR", r"(?P<value>YES|NO)\b")
+_FOUND_TEXT_RE = _field_re("FOUND_TEXT", r"(?P<value>.*?)\s*" + _NEXT_FIELD.format("SPECIFIC_FIX|VALIDATION"))
+_SPECIFIC_FIX_RE = _field_re("SPECIFIC_FIX", r"(?P<value>.*?)\s*" + _NEXT_FIELD.format("VALIDATION"))
+_VERDICT_RE = _field_re("VALIDATION", r"(?P<value>APPROVED|REJECTED)\b")
 
-    Returns:
-        Updated state with text_validation_result and text_validation_feedback
-    """
-    print("\n=== STAGE 6a: TEXT VALIDATION AGENT ===")
-    config.log_stage("STAGE 6a: TEXT VALIDATION AGENT", "Starting text validation...")
 
-    attempt_num = state.get("text_adding_attempt_count", 1)
-    print(f"Text validation for attempt {attempt_num}/{config.MAX_TEXT_ADDING_ATTEMPTS}")
-    config.log_message(f"Validation attempt: {attempt_num}/{config.MAX_TEXT_ADDING_ATTEMPTS}")
+def _field_value(pattern: re.Pattern, text: str):
+    """First value of a field, with surrounding markdown stripped, or None if absent."""
+    match = pattern.search(text)
+    return match["value"].strip("*_ \n") if match else None
 
-    # Get inputs
-    generated_text = state.get("best_text") or state.get("generated_text")
-    poster_path = state.get("poster_with_text")
 
-    config.log_message(f"\nExpected text:\n{generated_text}")
-    config.log_message(f"\nPoster image path: {poster_path}")
+def _parse_validation_result(validation_result: str) -> dict:
+    """
+    Parse the text validation response field by field.
 
-    # Initialize OpenRouter client
-    client = OpenAI(
-        base_url=config.OPENROUTER_BASE_URL,
-        api_key=config.OPENROUTER_API_KEY,
-    )
+    A missing verdict or YES/NO field counts as rejected/NO, and a missing
+    SPECIFIC_FIX is empty; the other fields are still used.
+    """
+    verdict = _field_value(_VERDICT_RE, validation_result)
+    correct = _field_value(_TEXT_CORRECT_RE, validation_result)
+    clear = _field_value(_TEXT_CLEAR_RE, validation_result)
+    return {
+        "approved": (verdict or "").upper() == "APPROVED",
+        "text_is_correct": (correct or "").upper() == "YES",
+        "text_is_clear": (clear or "").upper() == "YES",
+        "found_text": _field_value(_FOUND_TEXT_RE, validation_result),
+        "specific_fix": _field_value(_SPECIFIC_FIX_RE, validation_result) or "",
+    }
 
-    # Encode the poster image
-    poster_base64 = encode_image(poster_path)
 
-    # Create validation prompt
-    validation_prompt = f"""You are validating that text has been correctly added to a poster image.
+# Static validation instructions, sent as a cacheable system prefix
+TEXT_VALIDATION_INSTRUCTIONS = """You are validating that text has been correctly added to a poster image.
 
-EXPECTED TEXT (must match exactly):
-{generated_text}
+You will receive the expected text, followed by the poster image.
 
 Please analyze the poster image and determine:
 1. TEXT_CORRECT: Does the text content match the expected text exactly? (YES/NO)
@@ -77,13 +79,55 @@ VALIDATION: [APPROVED or REJECTED]
 
 Be thorough and strict in your evaluation."""
 
-    config.log_message(f"\nValidation prompt sent to LLM:\n{validation_prompt}")
+
+async def text_validation_agent(state: AgentState, bypass_cache: bool = False) -> AgentState:
+    """
+    Stage 6a: Text Validation Agent
+
+    Validates that text added to poster matches generated text exactly.
+    Checks for: exact match, blur, cutoff, spelling errors.
+
+    Args:
+        state: Current agent state with best_text and poster_with_text
+        bypass_cache: Skip the LLM response cache for this call
+
+    Returns:
+        Updated state with text_validation_result and text_validation_feedback
+    """
+    print("\n=== STAGE 6a: TEXT VALIDATION AGENT ===")
+    config.log_stage("STAGE 6a: TEXT VALIDATION AGENT", "Starting text validation...")
+
+    attempt_num = state.text_adding_attempt_count
+    print(f"Text validation for attempt {attempt_num}/{config.MAX_TEXT_ADDING_ATTEMPTS}")
+    config.log_message(f"Validation attempt: {attempt_num}/{config.MAX_TEXT_ADDING_ATTEMPTS}")
+
+    # Get inputs
+    generated_text = state.best_text or state.generated_text
+    poster_path = state.poster_with_text
+
+    config.log_message(f"\nExpected text:\n{generated_text}")
+    config.log_message(f"\nPoster image path: {poster_path}")
+
+    # Shared OpenRouter client
+    client = get_client()
+
+    # Encode the poster image off the event loop
+    poster_data_url = await asyncio.to_thread(vision_data_url, poster_path)
+
+    # Create validation prompt (per-call content only; instructions are the cached system prefix)
+    validation_prompt = f"""EXPECTED TEXT (must match exactly):
+{generated_text}"""
+
+    config.log_message(f"\nValidation prompt sent to LLM:\n{TEXT_VALIDATION_INSTRUCTIONS}\n\n{validation_prompt}")
 
     try:
         # Call OpenRouter API with vision
-        response = client.chat.completions.create(
+        response = await cached_chat_completion(
+            client,
+            bypass_cache=bypass_cache,
             model=config.OPENROUTER_MODEL,
             messages=[
+                system_message(TEXT_VALIDATION_INSTRUCTIONS),
                 {
                     "role": "user",
                     "content": [
@@ -94,7 +138,7 @@ Be thorough and strict in your evaluation."""
                         {
                             "type": "image_url",
                             "image_url": {
-                                "url": f"data:image/png;base64,{poster_base64}",
+                                "url": poster_data_url,
                                 "detail": "high"
                             }
                         }
@@ -102,47 +146,27 @@ Be thorough and strict in your evaluation."""
                 }
             ],
             max_tokens=500,
+            temperature=0,
         )
 
         validation_result = response.choices[0].message.content
         config.log_message(f"\nLLM Response:\n{validation_result}")
 
         # Parse structured validation result
-        validation_approved = "VALIDATION: APPROVED" in validation_result.upper()
-
-        # Extract TEXT_CORRECT
-        text_is_correct = "TEXT_CORRECT: YES" in validation_result.upper()
-
-        # Extract TEXT_CLEAR
-        text_is_clear = "TEXT_CLEAR: YES" in validation_result.upper()
-
-        # Extract FOUND_TEXT
-        found_text = None
-        if "FOUND_TEXT:" in validation_result:
-            found_text_section = validation_result.split("FOUND_TEXT:")[1]
-            # Get until next field or end
-            for field in ["SPECIFIC_FIX:", "VALIDATION:"]:
-                if field in found_text_section:
-                    found_text_section = found_text_section.split(field)[0]
-                    break
-            found_text = found_text_section.strip()
-
-        # Extract SPECIFIC_FIX
-        specific_fix = None
-        if "SPECIFIC_FIX:" in validation_result:
-            specific_fix_section = validation_result.split("SPECIFIC_FIX:")[1]
-            # Get until VALIDATION field
-            if "VALIDATION:" in specific_fix_section:
-                specific_fix_section = specific_fix_section.split("VALIDATION:")[0]
-            specific_fix = specific_fix_section.strip()
+        parsed = _parse_validation_result(validation_result)
+        validation_approved = parsed["approved"]
+        text_is_correct = parsed["text_is_correct"]
+        text_is_clear = parsed["text_is_clear"]
+        found_text = parsed["found_text"]
+        specific_fix = parsed["specific_fix"]
 
         # Update state with all parsed values
-        state["text_validation_result"] = "approved" if validation_approved else "rejected"
-        state["text_validation_feedback"] = validation_result
-        state["text_is_correct"] = text_is_correct
-        state["text_is_clear"] = text_is_clear
-        state["found_text"] = found_text
-        state["specific_fix"] = specific_fix
+        state.text_validation_result = "approved" if validation_approved else "rejected"
+        state.text_validation_feedback = validation_result
+        state.text_is_correct = text_is_correct
+        state.text_is_clear = text_is_clear
+        state.found_text = found_text
+        state.specific_fix = specific_fix
 
         print(f"Validation result: {'APPROVED' if validation_approved else 'REJECTED'}")
         print(f"Text correct: {text_is_correct}, Text clear: {text_is_clear}")
@@ -159,35 +183,51 @@ Be thorough and strict in your evaluation."""
         config.log_message(f"Traceback:\n{traceback.format_exc()}")
 
         # On error, reject to allow retry
-        state["text_validation_result"] = "rejected"
-        state["text_validation_feedback"] = f"Validation failed due to error: {str(e)}"
-        state["text_is_correct"] = False
-        state["text_is_clear"] = False
-        state["found_text"] = None
-        state["specific_fix"] = None
+        state.text_validation_result = "rejected"
+        state.text_validation_feedback = f"Validation failed due to error: {str(e)}"
+        state.text_is_correct = False
+        state.text_is_clear = False
+        state.found_text = None
+        state.specific_fix = None
 
     return state
 
 
 def should_retry_text_adding(state: AgentState) -> str:
     """
-    Decision function for text adding retry loop.
+    Router for the text adding retry loop.
+
+    A partial failure (correct but unclear text, or clear but incorrect text)
+    keeps the previous poster and only re-runs text adding on it, with the
+    specific_fix instruction (or the initial prompt when there is none).
+    Only when the text is both wrong and unclear is the poster discarded and
+    the text added again from scratch on the best image.
 
     Returns:
-        "retry" if should retry text adding, "continue" otherwise
+        "continue" to proceed to output, "retry_text_add_only" to apply
+        specific_fix to the previous poster, or "retry_full" to redo text
+        addition from the best image
     """
-    attempt_count = state.get("text_adding_attempt_count", 0)
-    validation_result = state.get("text_validation_result", "rejected")
+    attempt_count = state.text_adding_attempt_count
+    validation_result = state.text_validation_result
 
     if validation_result == "approved":
         print("\nText validation passed. Proceeding to final output.")
         config.log_message("\nDecision: Text validation passed, proceeding to output.")
         return "continue"
-    elif attempt_count < config.MAX_TEXT_ADDING_ATTEMPTS:
-        print(f"\nText validation failed. Retrying text addition (attempt {attempt_count + 1}/{config.MAX_TEXT_ADDING_ATTEMPTS})...")
-        config.log_message(f"\nDecision: Retrying text addition (attempt {attempt_count + 1}/{config.MAX_TEXT_ADDING_ATTEMPTS})")
-        return "retry"
-    else:
+
+    if attempt_count >= config.MAX_TEXT_ADDING_ATTEMPTS:
         print(f"\nMax text adding attempts ({config.MAX_TEXT_ADDING_ATTEMPTS}) reached. Continuing with best attempt.")
         config.log_message(f"\nDecision: Max attempts reached, continuing with best attempt")
         return "continue"
+
+    text_is_correct = state.text_is_correct
+    text_is_clear = state.text_is_clear
+    if text_is_correct or text_is_clear:
+        print(f"\nText validation partially failed. Applying fix only (attempt {attempt_count + 1}/{config.MAX_TEXT_ADDING_ATTEMPTS})...")
+        config.log_message(f"\nDecision: Retrying text addition with specific fix only (attempt {attempt_count + 1}/{config.MAX_TEXT_ADDING_ATTEMPTS})")
+        return "retry_text_add_only"
+
+    print(f"\nText validation failed. Retrying text addition from best image (attempt {attempt_count + 1}/{config.MAX_TEXT_ADDING_ATTEMPTS})...")
+    config.log_message(f"\nDecision: Retrying full text addition (attempt {attempt_count + 1}/{config.MAX_TEXT_ADDING_ATTEMPTS})")
+    return "retry_full"
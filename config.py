@@ -2,6 +2,8 @@
 Configuration module for loading environment variables.
 """
 import os
+import asyncio
+import aiofiles
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -14,9 +16,43 @@ HUGGINGFACE_TOKEN = os.getenv("HUGGINGFACE_TOKEN")
 # Model configurations
 OPENROUTER_MODEL = "x-ai/grok-4.1-fast"  # Grok 4.1 Fast (was sherlock-dash-alpha)
 OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+# Local text validation (enable with ARIN_LOCAL_TEXT_VALIDATION=1): text passing the local
+# checks skips the LLM validator. This needs deterministic single-candidate generation,
+# so the switch also sets temperature 0 and n=1.
+LOCAL_TEXT_VALIDATION_ENABLED = os.getenv("ARIN_LOCAL_TEXT_VALIDATION") == "1"
+TEXT_GENERATION_TEMPERATURE = 0 if LOCAL_TEXT_VALIDATION_ENABLED else 0.8  # Sampled so candidates are varied; other stages use 0
+TEXT_CANDIDATES_PER_CALL = 1 if LOCAL_TEXT_VALIDATION_ENABLED else 4  # Text candidates sampled per generation request (n=)
 
 HUGGINGFACE_MODEL = "Qwen/Qwen-Image-Edit"
-HUGGINGFACE_INFERENCE_STEPS = 50
+# Each step is a transformer pass; ARIN_FAST_STEPS=1 opts into 25 steps (unvalidated quality, no scheduler change)
+HUGGINGFACE_INFERENCE_STEPS = 25 if os.getenv("ARIN_FAST_STEPS") == "1" else 50
+TRUE_CFG_ON_IMAGE_RETRIES = True  # False: image retries skip the negative-prompt pass (half the transformer cost per step)
+IMAGE_CANDIDATES_PER_CALL = 1  # Image candidates denoised as one batch (num_images_per_prompt)
+PIPELINE_IMAGE_AREA = 1024 * 1024  # Qwen-Image-Edit resizes its input to about this many pixels
+
+# Diffusers pipeline optimizations (agents/_pipeline.py, CUDA only)
+FUSE_QKV_PROJECTIONS = True  # Fuse attention Q/K/V projections into a single matmul
+ATTENTION_BACKENDS = ("_flash_3", "flash", "native")  # diffusers attention backends, first available wins (Ampere+)
+QUANTIZE_PIPELINE = os.getenv("ARIN_QUANTIZE_PIPELINE") == "1"  # int8 dynamic quantization (requires torchao)
+COMPILE_PIPELINE = os.getenv("ARIN_COMPILE_PIPELINE") == "1"  # Regional torch.compile of transformer blocks + VAE decoder
+COMPILE_MODE = "max-autotune"  # Includes CUDA graph capture of the compiled transformer (per prompt length)
+COMPILE_WARMUP_STEPS = 2  # Denoising steps of the warmup call that triggers compilation
+CACHE_DIT_ENABLED = os.getenv("ARIN_CACHE_DIT") == "1"  # Reuse DiT block outputs across steps (requires cache-dit)
+
+# Model CPU offload: only the active component (text encoder, transformer, VAE) stays on the GPU.
+# Also enabled automatically on GPUs with less than OFFLOAD_BELOW_GPU_MEMORY_GB of memory.
+ENABLE_OFFLOAD = os.getenv("ARIN_ENABLE_OFFLOAD") == "1"
+OFFLOAD_BELOW_GPU_MEMORY_GB = 24
+
+# Pipeline server (server.py); when set, load_pipeline connects instead of loading the model
+PIPELINE_SERVER_ADDRESS = os.getenv("ARIN_PIPELINE_SERVER")  # e.g. "127.0.0.1:6000"
+# Required for both server and client; the server unpickles requests, so never use a shared default
+PIPELINE_SERVER_AUTHKEY = (os.getenv("ARIN_PIPELINE_SERVER_AUTHKEY") or "").encode() or None
+
+# Vision request image preprocessing
+VISION_MAX_SIDE = 2048  # Images are downscaled to this max side before upload
+VISION_JPEG_QUALITY = 85
+VISION_LOW_DETAIL_MAX_SIDE = 512  # "detail": "low" requests are seen at 512x512
 
 # Retry configurations
 MAX_TEXT_ATTEMPTS = 10
@@ -24,6 +60,42 @@ MAX_IMAGE_ATTEMPTS = 3
 MAX_IMAGE_COMPLETE_FAILURE_ATTEMPTS = 15  # Extended retries for complete failures
 MAX_TEXT_ADDING_ATTEMPTS = 10
 
+# Concurrency configurations
+SPECULATIVE_TEXT_ATTEMPTS = 3  # Text attempts launched concurrently on each retry
+MAX_CONCURRENT_REQUESTS = 4  # Upper bound on in-flight LLM requests per fan-out
+
+# HTTP connection pool for the shared OpenRouter client (agents/_client.py)
+HTTP_MAX_CONNECTIONS = 64
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 32
+HTTP_KEEPALIVE_EXPIRY_SECONDS = 60
+
+# LLM response cache (enable with ARIN_LLM_CACHE=1, only temperature 0 calls are cached)
+LLM_CACHE_ENABLED = os.getenv("ARIN_LLM_CACHE") == "1"
+LLM_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "arin5201")
+LLM_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60  # One week
+
+# Plan cache (enable with ARIN_PLAN_CACHE_ENABLED=1)
+PLAN_CACHE_ENABLED = os.getenv("ARIN_PLAN_CACHE_ENABLED") == "1"
+PLAN_CACHE_PATH = os.path.join(LLM_CACHE_DIR, "plan_cache.sqlite3")
+PLAN_CACHE_EMBEDDING_MODEL = "openai/text-embedding-3-small"
+PLAN_CACHE_SIMILARITY_THRESHOLD = 0.90  # Minimum cosine similarity of input text embeddings
+PLAN_CACHE_MAX_PHASH_DISTANCE = 6  # Maximum Hamming distance between logo perceptual hashes
+PLAN_ADAPT_MODEL = "openai/gpt-4o-mini"  # Smaller model used to adapt a cached plan
+
+# Local image pre-validation (agents/local_gates.py, enable with ARIN_LOCAL_GATE=1)
+LOCAL_GATE_ENABLED = os.getenv("ARIN_LOCAL_GATE") == "1"
+LOCAL_GATE_EXPECTED_SIZE = None  # e.g. (720, 1280); Qwen-Image-Edit keeps the input aspect ratio, so unset by default
+LOCAL_GATE_MIN_SHARPNESS = 100.0  # Minimum Laplacian variance
+LOCAL_GATE_MAX_LOGO_PHASH_DISTANCE = 24  # Maximum hash distance between the logo and its best-matching crop
+LOCAL_GATE_CLIP_MODEL_PATH = os.getenv("ARIN_LOCAL_GATE_CLIP_MODEL")  # ONNX CLIP vision encoder (e.g. int8-quantized)
+LOCAL_GATE_MIN_CLIP_SIMILARITY = 0.25
+
+# Batch API configuration (agents/batch_runner.py, OpenAI Batch API)
+BATCH_BASE_URL = "https://api.openai.com/v1"
+BATCH_API_KEY = os.getenv("OPENAI_API_KEY")
+BATCH_MODEL = "gpt-4o"  # Batch requests go to OpenAI directly, so use an OpenAI model name
+BATCH_POLL_INTERVAL_SECONDS = 60
+
 # LangGraph configuration
 RECURSION_LIMIT = 100  # Maximum number of graph iterations (increase if hitting recursion errors)
 
@@ -41,15 +113,97 @@ if not HUGGINGFACE_TOKEN:
     raise ValueError("HUGGINGFACE_TOKEN not found in environment variables")
 
 
+# Set once the intermediate output directory has been created
+_intermediate_dir_ready = False
+
+# Background log writer state (see start_log_writer)
+_log_queue = None
+_log_loop = None
+_log_task = None
+
+
+def ensure_intermediate_dir():
+    """Create the intermediate output directory once per process."""
+    global _intermediate_dir_ready
+    if not _intermediate_dir_ready:
+        os.makedirs(INTERMEDIATE_DIR, exist_ok=True)
+        _intermediate_dir_ready = True
+
+
 # Logging utility functions
 def init_log():
     """Initialize/clear the log file at start of run."""
-    os.makedirs(INTERMEDIATE_DIR, exist_ok=True)
+    ensure_intermediate_dir()
     with open(PIPELINE_LOG_PATH, "w", encoding="utf-8") as f:
         f.write("POSTER GENERATOR PIPELINE LOG\n")
         f.write(f"{'='*60}\n\n")
 
 
+async def _drain_log_queue():
+    """Write queued log entries, batching whatever has piled up since the last write."""
+    while True:
+        entries = [await _log_queue.get()]
+        while not _log_queue.empty():
+            entries.append(_log_queue.get_nowait())
+        async with aiofiles.open(PIPELINE_LOG_PATH, "a", encoding="utf-8") as f:
+            await f.write("".join(entries))
+        for _ in entries:
+            _log_queue.task_done()
+
+
+async def start_log_writer():
+    """
+    Start the background log writer on the running event loop.
+
+    While it runs, log_stage/log_message only enqueue entries, so agent code
+    never blocks on log file I/O.
+    """
+    global _log_queue, _log_loop, _log_task
+    _log_queue = asyncio.Queue()
+    _log_loop = asyncio.get_running_loop()
+    _log_task = asyncio.create_task(_drain_log_queue())
+
+
+async def stop_log_writer():
+    """
+    Flush pending log entries and stop the background log writer.
+
+    If the writer died (e.g. on a write error), queued entries are never
+    marked done, so the flush also stops as soon as the writer task ends and
+    its exception is reported instead of waiting forever.
+    """
+    global _log_queue, _log_loop, _log_task
+    if _log_task is None:
+        return
+    if not _log_task.done():
+        flushed = asyncio.create_task(_log_queue.join())
+        await asyncio.wait({flushed, _log_task}, return_when=asyncio.FIRST_COMPLETED)
+        flushed.cancel()
+    if _log_task.done() and not _log_task.cancelled() and _log_task.exception() is not None:
+        print(f"Warning: log writer failed, remaining log entries were not written: {_log_task.exception()}")
+    _log_task.cancel()
+    _log_queue = _log_loop = _log_task = None
+
+
+def _write_log(text: str):
+    """Append text to the log, through the background writer when it is running."""
+    if _log_queue is None:
+        with open(PIPELINE_LOG_PATH, "a", encoding="utf-8") as f:
+            f.write(text)
+        return
+
+    try:
+        on_log_loop = asyncio.get_running_loop() is _log_loop
+    except RuntimeError:
+        on_log_loop = False
+
+    if on_log_loop:
+        _log_queue.put_nowait(text)
+    else:
+        # Called from a worker thread (e.g. the diffusers agents)
+        _log_loop.call_soon_threadsafe(_log_queue.put_nowait, text)
+
+
 def log_stage(stage_name: str, content: str):
     """
     Log content to pipeline log file with stage header.
@@ -58,15 +212,9 @@ def log_stage(stage_name: str, content: str):
         stage_name: Name of the stage (e.g., "STAGE 1: PLANNING AGENT")
         content: Content to log
     """
-    with open(PIPELINE_LOG_PATH, "a", encoding="utf-8") as f:
-        f.write(f"\n{'='*60}\n")
-        f.write(f"{stage_name}\n")
-        f.write(f"{'='*60}\n")
-        f.write(content)
-        f.write(f"\n")
+    _write_log(f"\n{'='*60}\n{stage_name}\n{'='*60}\n{content}\n")
 
 
 def log_message(message: str):
     """Log a message without stage header."""
-    with open(PIPELINE_LOG_PATH, "a", encoding="utf-8") as f:
-        f.write(f"{message}\n")
+    _write_log(f"{message}\n")
@@ -2,20 +2,25 @@
 Main orchestration file for the LangGraph-based poster generator system.
 """
 import os
+import copy
 import shutil
+import asyncio
+import aiofiles
+import torch
 from langgraph.graph import StateGraph, END
 from state import AgentState
 import config
 
-# Import diffusers for pipeline initialization
-from diffusers import QwenImageEditPipeline
-import torch
-
 # Import agent functions
+from agents._client import close_client
+from agents._pipeline import get_pipeline, cache_summary, RemotePipeline
+from agents._image_utils import vision_data_url, map_pipeline_image, submit_file_write, wait_for_file, wait_for_pending_saves
+from agents import plan_cache
 from agents.planning_agent import planning_agent
 from agents.text_generation_agent import (
     text_generation_agent,
     validate_text,
+    speculative_text_retry,
     should_retry_text
 )
 from agents.editor_agent import editor_agent, should_retry_image
@@ -41,41 +46,39 @@ def load_pipeline(state: AgentState) -> AgentState:
     config.log_stage("STAGE 0a: LOADING DIFFUSERS PIPELINE", "Loading diffusers model...")
 
     try:
+        if config.PIPELINE_SERVER_ADDRESS:
+            # A pipeline server (server.py) already holds the loaded model
+            print(f"Connecting to pipeline server: {config.PIPELINE_SERVER_ADDRESS}")
+            config.log_message(f"Using pipeline server at {config.PIPELINE_SERVER_ADDRESS}")
+            state.image_pipeline = RemotePipeline(config.PIPELINE_SERVER_ADDRESS, config.PIPELINE_SERVER_AUTHKEY)
+            return state
+
         print(f"Loading model: {config.HUGGINGFACE_MODEL}")
         print("This may take a few minutes on first run (downloading model)...")
         config.log_message(f"Loading model: {config.HUGGINGFACE_MODEL}")
 
-        # Load the pipeline using QwenImageEditPipeline
-        pipeline = QwenImageEditPipeline.from_pretrained(
-            config.HUGGINGFACE_MODEL  # "Qwen/Qwen-Image-Edit"
-        )
-
-        # Move to bfloat16 and GPU if available
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-
-        # Use bfloat16 if on CUDA, otherwise float32
-        if device == "cuda":
-            pipeline = pipeline.to(torch.bfloat16)
-
-        pipeline = pipeline.to(device)
+        # Reuses the pipeline if this process already loaded it (repeated workflow runs)
+        pipeline, device = get_pipeline()
 
         print(f"Pipeline loaded successfully on {device}")
         config.log_message(f"Pipeline loaded successfully on {device}")
 
         # Store in state
-        state["image_pipeline"] = pipeline
+        state.image_pipeline = pipeline
+        state.pipeline_cache_summary = cache_summary(pipeline)
 
     except Exception as e:
         error_msg = f"Warning: Failed to load diffusers pipeline: {e}"
         print(error_msg)
         print("Image generation will fall back to using base images")
         config.log_message(f"\nERROR: {error_msg}")
-        state["image_pipeline"] = None
+        state.image_pipeline = None
+        state.pipeline_cache_summary = None
 
     return state
 
 
-def load_input(state: AgentState) -> AgentState:
+async def load_input(state: AgentState) -> AgentState:
     """
     Stage 0b: Load input text and image.
 
@@ -92,8 +95,8 @@ def load_input(state: AgentState) -> AgentState:
     if not os.path.exists(config.INPUT_TEXT_PATH):
         raise FileNotFoundError(f"Input text file not found: {config.INPUT_TEXT_PATH}")
 
-    with open(config.INPUT_TEXT_PATH, "r") as f:
-        input_text = f.read().strip()
+    async with aiofiles.open(config.INPUT_TEXT_PATH, "r") as f:
+        input_text = (await f.read()).strip()
 
     # Verify input image exists
     if not os.path.exists(config.INPUT_IMAGE_PATH):
@@ -105,19 +108,87 @@ def load_input(state: AgentState) -> AgentState:
     config.log_message(f"Input image: {config.INPUT_IMAGE_PATH}")
 
     # Initialize state
-    state["input_text"] = input_text
-    state["input_image_path"] = config.INPUT_IMAGE_PATH
-    state["text_attempt_count"] = 0
-    state["image_attempt_count"] = 0
-    state["image_complete_failure_count"] = 0
-    state["text_adding_attempt_count"] = 0
-    state["validation_passed"] = False
+    state.input_text = input_text
+    state.input_image_path = config.INPUT_IMAGE_PATH
+    state.text_attempt_count = 0
+    state.image_attempt_count = 0
+    state.image_complete_failure_count = 0
+    state.text_adding_attempt_count = 0
+    state.validation_passed = False
+    state.text_generation_passed = False
 
     config.log_message("\nState initialized with counters set to 0")
 
+    # Image decoding/encoding is CPU-bound, keep it off the event loop
+    return await asyncio.to_thread(warmup_state, state)
+
+
+def warmup_state(state: AgentState) -> AgentState:
+    """
+    Precompute the input logo artifacts used by several stages.
+
+    The logo's vision data URL (planning and editor) and perceptual hash
+    (plan cache) are computed once here instead of in every stage, and the
+    image is decoded once for the pipeline so image retries on the input
+    never re-read the file.
+
+    Args:
+        state: Agent state with input_image_path
+
+    Returns:
+        Updated state with _input_logo_b64_url, _input_logo_phash and input_image
+    """
+    state._input_logo_b64_url = vision_data_url(state.input_image_path)
+    state._input_logo_phash = plan_cache.compute_logo_phash(state.input_image_path)
+    state._current_image_b64_url = None
+    state.input_image = map_pipeline_image(state.input_image_path)
+    config.log_message("Precomputed input logo data URL, perceptual hash and decoded image")
     return state
 
 
+# State keys written by each parallel branch (kept disjoint so concurrent updates never collide)
+TEXT_BRANCH_KEYS = (
+    "generated_text", "text_attempt_count", "best_text", "pending_text_candidates",
+    "text_generation_feedback", "text_generation_passed",
+)
+IMAGE_BRANCH_KEYS = (
+    "current_image", "image_attempt_count", "best_image", "pending_image_candidates",
+    "validation_feedback", "validation_passed", "_current_image_b64_url",
+)
+
+
+def branch_node(agent, keys: tuple):
+    """
+    Wrap an agent for one of the parallel text/image branches.
+
+    The agent runs on its own copy of the state and only the keys owned by
+    its branch are returned as the update, so the other branch's writes in
+    the same step are left alone.
+
+    Args:
+        agent: Agent function (sync or async) taking and returning the state
+        keys: State keys owned by the agent's branch
+
+    Returns:
+        Node function returning a partial state update
+    """
+    if asyncio.iscoroutinefunction(agent):
+        async def node(state: AgentState) -> dict:
+            result = await agent(copy.copy(state))
+            return {key: getattr(result, key) for key in keys}
+    else:
+        def node(state: AgentState) -> dict:
+            result = agent(copy.copy(state))
+            return {key: getattr(result, key) for key in keys}
+    node.__name__ = agent.__name__
+    return node
+
+
+def branch_done(state: AgentState) -> dict:
+    """Join point of a parallel branch; segmentation waits for both."""
+    return {}
+
+
 def segmentation_placeholder(state: AgentState) -> AgentState:
     """
     Stage 5: Segmentation (placeholder - currently just pass through).
@@ -134,7 +205,37 @@ def segmentation_placeholder(state: AgentState) -> AgentState:
     return state
 
 
-def save_output(state: AgentState) -> AgentState:
+def reset_text_adding(state: AgentState) -> AgentState:
+    """
+    Drop the rejected poster so the next text addition starts from the best image.
+
+    Args:
+        state: Current agent state after a fully failed text validation
+
+    Returns:
+        State with poster_with_text and specific_fix cleared
+    """
+    config.log_message("\nDiscarding rejected poster_with_text, restarting text addition from best image")
+    state.poster_with_text = None
+    state.specific_fix = None
+    return state
+
+
+def _copy_file(source_path: str, output_path: str):
+    """
+    Copy source_path to output_path as an independent file.
+
+    An existing output is unlinked first rather than truncated, so a poster
+    hardlinked by an earlier version never shares its inode with an
+    intermediate file that a later run rewrites. shutil.copyfile copies
+    in-kernel (sendfile) on Linux.
+    """
+    if os.path.lexists(output_path):
+        os.remove(output_path)
+    shutil.copyfile(source_path, output_path)
+
+
+async def save_output(state: AgentState) -> AgentState:
     """
     Stage 7: Save final outputs.
 
@@ -151,27 +252,37 @@ def save_output(state: AgentState) -> AgentState:
     os.makedirs(config.OUTPUT_DIR, exist_ok=True)
 
     # Save final poster
-    poster_source = state.get("poster_with_text")
+    poster_source = state.poster_with_text
+    if poster_source:
+        # A background save may still be writing it
+        await asyncio.to_thread(wait_for_file, poster_source)
     if not poster_source or not os.path.exists(poster_source):
         print("Warning: poster_with_text not found, using best_image")
         config.log_message("WARNING: poster_with_text not found, using best_image")
-        poster_source = state.get("best_image") or state.get("current_image")
+        poster_source = state.best_image or state.current_image
+        await asyncio.to_thread(wait_for_file, poster_source)
 
     final_poster_path = os.path.join(config.OUTPUT_DIR, "poster.png")
-    shutil.copy(poster_source, final_poster_path)
-    state["final_poster_path"] = final_poster_path
+    # Copied in the background; run_workflow waits for pending saves before exiting
+    submit_file_write(final_poster_path, _copy_file, poster_source, final_poster_path)
+    state.final_poster_path = final_poster_path
     print(f"Final poster saved to: {final_poster_path}")
     config.log_message(f"Final poster saved to: {final_poster_path}")
 
     # Save final text
-    final_text = state.get("best_text") or state.get("generated_text")
+    final_text = state.best_text or state.generated_text
     final_text_path = os.path.join(config.OUTPUT_DIR, "text.txt")
-    with open(final_text_path, "w") as f:
-        f.write(final_text)
-    state["final_text_path"] = final_text_path
+    async with aiofiles.open(final_text_path, "w") as f:
+        await f.write(final_text)
+    state.final_text_path = final_text_path
     print(f"Final text saved to: {final_text_path}")
     config.log_message(f"Final text saved to: {final_text_path}")
 
+    if torch.cuda.is_available():
+        peak_gb = torch.cuda.max_memory_allocated() / 1024**3
+        print(f"Peak GPU memory allocated: {peak_gb:.2f} GB")
+        config.log_message(f"Peak GPU memory allocated: {peak_gb:.2f} GB")
+
     print("\n=== POSTER GENERATION COMPLETE ===")
     print(f"Final poster: {final_poster_path}")
     print(f"Final text: {final_text_path}")
@@ -199,31 +310,48 @@ def build_graph() -> StateGraph:
     workflow.add_node("load_pipeline", load_pipeline)
     workflow.add_node("load_input", load_input)
     workflow.add_node("planning", planning_agent)
-    workflow.add_node("text_generation", text_generation_agent)
-    workflow.add_node("text_validation", validate_text)
-    workflow.add_node("image_generation", image_generation_agent)
-    workflow.add_node("image_validation", editor_agent)
+    workflow.add_node("text_generation", branch_node(text_generation_agent, TEXT_BRANCH_KEYS))
+    workflow.add_node("text_validation", branch_node(validate_text, TEXT_BRANCH_KEYS))
+    workflow.add_node("text_retry", branch_node(speculative_text_retry, TEXT_BRANCH_KEYS))
+    workflow.add_node("text_done", branch_done)
+    workflow.add_node("image_generation", branch_node(image_generation_agent, IMAGE_BRANCH_KEYS))
+    workflow.add_node("image_validation", branch_node(editor_agent, IMAGE_BRANCH_KEYS))
+    workflow.add_node("image_done", branch_done)
     workflow.add_node("segmentation", segmentation_placeholder)
     workflow.add_node("text_adding", text_adding_agent)
     workflow.add_node("text_adding_validation", text_validation_agent)  # NEW: Stage 6a
+    workflow.add_node("text_adding_reset", reset_text_adding)
     workflow.add_node("save_output", save_output)
 
     # Define the workflow edges
     workflow.set_entry_point("load_pipeline")
 
-    # Linear flow: load_pipeline -> load_input -> planning -> text_generation
+    # Linear flow: load_pipeline -> load_input -> planning
     workflow.add_edge("load_pipeline", "load_input")
     workflow.add_edge("load_input", "planning")
+
+    # Fan out: text and image generation both depend only on the plan, so their
+    # retry loops run as parallel branches
     workflow.add_edge("planning", "text_generation")
+    workflow.add_edge("planning", "image_generation")
 
     # Text generation retry loop (Stage 2 with validation)
+    # Retries fan out several concurrent attempts via speculative_text_retry
     workflow.add_edge("text_generation", "text_validation")
     workflow.add_conditional_edges(
         "text_validation",
         should_retry_text,
         {
-            "retry": "text_generation",
-            "continue": "image_generation"
+            "retry": "text_retry",
+            "continue": "text_done"
+        }
+    )
+    workflow.add_conditional_edges(
+        "text_retry",
+        should_retry_text,
+        {
+            "retry": "text_retry",
+            "continue": "text_done"
         }
     )
 
@@ -235,23 +363,30 @@ def build_graph() -> StateGraph:
         should_retry_image,
         {
             "retry": "image_generation",
-            "continue": "segmentation"
+            "continue": "image_done"
         }
     )
 
+    # Fan in: segmentation runs once both branches are done
+    workflow.add_edge(["text_done", "image_done"], "segmentation")
+
     # Segmentation -> Text Adding
     workflow.add_edge("segmentation", "text_adding")
 
     # Text adding retry loop (Stage 6 with Stage 6a validation)
+    # Partial failures re-enter text_adding directly to apply the specific fix;
+    # full failures discard the rejected poster first
     workflow.add_edge("text_adding", "text_adding_validation")
     workflow.add_conditional_edges(
         "text_adding_validation",
         should_retry_text_adding,
         {
-            "retry": "text_adding",
+            "retry_text_add_only": "text_adding",
+            "retry_full": "text_adding_reset",
             "continue": "save_output"
         }
     )
+    workflow.add_edge("text_adding_reset", "text_adding")
 
     # Final output
     workflow.add_edge("save_output", END)
@@ -260,6 +395,29 @@ def build_graph() -> StateGraph:
     return workflow.compile()
 
 
+async def run_workflow(app, initial_state: AgentState) -> dict:
+    """
+    Run the compiled graph with the background log writer active.
+
+    Args:
+        app: Compiled StateGraph
+        initial_state: Initial agent state
+
+    Returns:
+        Final agent state values, keyed by field name
+    """
+    await config.start_log_writer()
+    try:
+        return await app.ainvoke(
+            initial_state,
+            config={"recursion_limit": config.RECURSION_LIMIT}
+        )
+    finally:
+        await asyncio.to_thread(wait_for_pending_saves)
+        await close_client()
+        await config.stop_log_writer()
+
+
 def main():
     """
     Main entry point for the poster generator system.
@@ -279,37 +437,11 @@ def main():
         app = build_graph()
 
         # Initialize empty state (will be populated by load_pipeline and load_input)
-        initial_state: AgentState = {
-            "input_text": "",
-            "input_image_path": "",
-            "image_pipeline": None,
-            "planning_output": None,
-            "generated_text": None,
-            "text_attempt_count": 0,
-            "best_text": None,
-            "current_image": None,
-            "image_attempt_count": 0,
-            "image_complete_failure_count": 0,
-            "best_image": None,
-            "validation_feedback": None,
-            "validation_passed": False,
-            "poster_with_text": None,
-            "text_adding_attempt_count": 0,
-            "text_validation_result": None,
-            "text_validation_feedback": None,
-            "text_is_correct": None,
-            "text_is_clear": None,
-            "found_text": None,
-            "specific_fix": None,
-            "final_poster_path": None,
-            "final_text_path": None,
-        }
+        initial_state = AgentState()
 
         # Run the workflow with recursion limit configuration
-        final_state = app.invoke(
-            initial_state,
-            config={"recursion_limit": config.RECURSION_LIMIT}
-        )
+        # Agents are async, so the graph runs on an event loop
+        final_state = asyncio.run(run_workflow(app, initial_state))
 
         print("\n" + "="*60)
         print("WORKFLOW COMPLETED SUCCESSFULLY")
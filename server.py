@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Pipeline server for the poster generator.
+Loads the diffusers pipeline once and serves generation calls over a
+multiprocessing connection, so workflow runs skip the model load.
+
+Usage:
+    python server.py [host:port]
+
+ARIN_PIPELINE_SERVER_AUTHKEY must be set to a secret; requests are
+unpickled, so anyone holding the key can run code in the server. Then run
+main.py with ARIN_PIPELINE_SERVER=host:port and the same authkey.
+"""
+import sys
+import threading
+import traceback
+from multiprocessing.connection import Listener
+import config
+from agents._pipeline import get_pipeline, run_pipeline, parse_server_address
+
+DEFAULT_ADDRESS = "127.0.0.1:6000"
+
+# One generation at a time on the shared pipeline
+_pipeline_lock = threading.Lock()
+
+
+def handle_connection(connection, pipeline):
+    """Serve pipeline calls from one client until it disconnects."""
+    with connection:
+        while True:
+            try:
+                inputs = connection.recv()
+            except EOFError:
+                return
+
+            try:
+                with _pipeline_lock:
+                    result = run_pipeline(pipeline, **inputs)
+                connection.send(("ok", result.images))
+            except Exception as e:
+                traceback.print_exc()
+                connection.send(("error", f"{type(e).__name__}: {e}"))
+
+
+def serve(address: str):
+    """
+    Load the pipeline and accept client connections forever.
+
+    Args:
+        address: "host:port" to listen on
+    """
+    if not config.PIPELINE_SERVER_AUTHKEY:
+        raise SystemExit("ARIN_PIPELINE_SERVER_AUTHKEY must be set; refusing to start the pipeline server")
+
+    print(f"Loading model: {config.HUGGINGFACE_MODEL}")
+    pipeline, device = get_pipeline()
+    print(f"Pipeline loaded on {device}")
+
+    with Listener(parse_server_address(address), authkey=config.PIPELINE_SERVER_AUTHKEY) as listener:
+        print(f"Pipeline server listening on {address}")
+        while True:
+            connection = listener.accept()
+            print(f"Client connected: {listener.last_accepted}")
+            threading.Thread(target=handle_connection, args=(connection, pipeline), daemon=True).start()
+
+
+if __name__ == "__main__":
+    serve(sys.argv[1] if len(sys.argv) > 1 else config.PIPELINE_SERVER_ADDRESS or DEFAULT_ADDRESS)
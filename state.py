@@ -1,52 +1,67 @@
 """
 State definition for the LangGraph poster generator system.
 """
-from typing import TypedDict, Optional, Any
+from dataclasses import dataclass
+from typing import Optional, Any
 
 
-class AgentState(TypedDict):
+@dataclass(slots=True)
+class AgentState:
     """
     Comprehensive state for the poster generation pipeline.
 
     Tracks all intermediate and final outputs across the multi-agent workflow.
+    Fields are accessed as attributes; every field has a default, so
+    AgentState() is the empty initial state.
     """
     # Stage 0: Input
-    input_text: str
-    input_image_path: str
+    input_text: str = ""
+    input_image_path: str = ""
+    input_image: Optional[Any] = None  # Input image decoded once (PIL, RGB) for the pipeline
+
+    # Input logo artifacts, computed once per run by warmup_state
+    _input_logo_b64_url: Optional[str] = None  # Vision data URL of the input logo
+    _input_logo_phash: Optional[int] = None  # Perceptual hash of the input logo (plan cache key)
+    _current_image_b64_url: Optional[tuple] = None  # (current_image path, data URL) memo for the editor
 
     # Diffusers pipeline (loaded once at start)
-    image_pipeline: Optional[Any]  # Stores the loaded diffusers pipeline
+    image_pipeline: Optional[Any] = None  # Stores the loaded diffusers pipeline
+    pipeline_cache_summary: Optional[str] = None  # cache-dit statistics (when enabled)
 
     # Stage 1: Planning Agent
-    planning_output: Optional[str]
+    planning_output: Optional[str] = None
 
     # Stage 2: Text Generation Agent (with retry loop)
-    generated_text: Optional[str]
-    text_attempt_count: int
-    best_text: Optional[str]
+    generated_text: Optional[str] = None
+    text_attempt_count: int = 0
+    best_text: Optional[str] = None
+    pending_text_candidates: Optional[list] = None  # Extra candidates from the last n-sampled call, judged by validate_text
+    text_generation_feedback: Optional[str] = None  # validate_text feedback (kept apart from the editor's)
+    text_generation_passed: bool = False
 
     # Stage 4: Image Generation Agent (with retry loop)
-    current_image: Optional[str]  # Path to current image attempt
-    image_attempt_count: int
-    best_image: Optional[str]  # Path to best image so far
-    image_complete_failure_count: int  # Extended retry counter for complete failures
+    current_image: Optional[str] = None  # Path to current image attempt
+    pending_image_candidates: Optional[list] = None  # Extra candidate paths from the last batched pipeline call
+    image_attempt_count: int = 0
+    best_image: Optional[str] = None  # Path to best image so far
+    image_complete_failure_count: int = 0  # Extended retry counter for complete failures
 
     # Stage 3: Editor Agent (validation feedback)
-    validation_feedback: Optional[str]
-    validation_passed: bool
+    validation_feedback: Optional[str] = None
+    validation_passed: bool = False
 
     # Stage 6: Text Adding Agent (with retry loop)
-    poster_with_text: Optional[str]  # Path to poster with text added
-    text_adding_attempt_count: int
+    poster_with_text: Optional[str] = None  # Path to poster with text added
+    text_adding_attempt_count: int = 0
 
     # Stage 6a: Text Validation Agent
-    text_validation_result: Optional[str]
-    text_validation_feedback: Optional[str]
-    text_is_correct: Optional[bool]  # Whether text content matches expected
-    text_is_clear: Optional[bool]  # Whether text is clearly generated (not blurry)
-    found_text: Optional[str]  # What text was actually found on the image
-    specific_fix: Optional[str]  # One-sentence instruction to fix the issue
+    text_validation_result: Optional[str] = None
+    text_validation_feedback: Optional[str] = None
+    text_is_correct: Optional[bool] = None  # Whether text content matches expected
+    text_is_clear: Optional[bool] = None  # Whether text is clearly generated (not blurry)
+    found_text: Optional[str] = None  # What text was actually found on the image
+    specific_fix: Optional[str] = None  # One-sentence instruction to fix the issue
 
     # Stage 7: Final outputs
-    final_poster_path: Optional[str]
-    final_text_path: Optional[str]
+    final_poster_path: Optional[str] = None
+    final_text_path: Optional[str] = None